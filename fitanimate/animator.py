@@ -2,16 +2,19 @@
 matplotlib animation
 '''
 import os
+import pickle
 
 from cycler import cycler
-from cartopy import crs
 
-import matplotlib.gridspec as gspec
 from matplotlib import animation
 import matplotlib.pyplot as plt
 
 import fitanimate.plot as fap
 import fitanimate.data as fad
+import fitanimate.layout as fla
+import fitanimate.output as fout
+import fitanimate.progress as fprog
+import fitanimate.pipeline as fpipe
 
 plt.rcdefaults()
 
@@ -29,6 +32,20 @@ default_fields = ['timestamp', 'temperature', 'heart_rate',
 default_plots = ['cadence', 'speed', 'power']
 
 
+# Pickled empty figures and plots, keyed by figure_template_key()
+figure_templates = {}
+
+
+def figure_template_key(args):
+    '''Return the options that determine the empty figure
+    '''
+    return (args.format, args.dpi, args.text_color, args.plot_color,
+            args.highlight_color, args.alpha, args.vertical,
+            args.elevation_factor, args.no_map, args.no_elevation,
+            args.projection, tuple(args.plots), tuple(args.fields),
+            tuple(args.layout))
+
+
 def get_font_size(x_size, dpi):
     '''Set font size for a given DPI.
     For 64 point font for 4k (x=3840,y=2160) @ 100 dpi
@@ -39,8 +56,8 @@ def get_font_size(x_size, dpi):
 class Element:
     '''An plot element to drawn
     '''
-    def __init__(self, gridspec=None, axis=None, plot=None):
-        self.gridspec = gridspec
+    def __init__(self, rect=None, axis=None, plot=None):
+        self.rect = rect  # [left, bottom, width, height] figure fractions
         self.axis = axis
         self.plot = plot
 
@@ -58,6 +75,10 @@ class Animator:
         self.elevation = None
         self.map = None
         self.bar = None
+        self.layout = None
+
+        # Functions called with fprog.Progress reports during animate()
+        self.progress_callbacks = []
 
     def setup(self):
         '''Sets up plots based on the passed arguments
@@ -67,6 +88,12 @@ class Animator:
             self.args.format = '360p'
             self.args.show = True
 
+        if self.args.preview:
+            self.args.format = '360p'
+
+        # Copies, as append arguments start from the shared default lists
+        self.args.plots = list(self.args.plots)
+        self.args.fields = list(self.args.fields)
         if len(self.args.plots) != len(default_plots):
             # The user specified plots, remove the defaults
             self.args.plots = self.args.plots[len(default_plots):]
@@ -74,10 +101,28 @@ class Animator:
         if len(self.args.fields) != len(default_fields):  # As above
             self.args.fields = self.args.fields[len(default_fields):]
 
+        # Remove the text of the plots that are not made
+        hidden = []
+        if self.args.no_elevation:
+            hidden += ['altitude', 'grad']
+
+        if self.args.no_map:
+            hidden.append('distance')
+
+        self.args.fields = [field for field in self.args.fields
+                            if field not in hidden]
+
+        self.setup_figure()
+        self.load_data()
+
+    def setup_figure(self):
+        '''Make the empty figure and plots. These only depend on the
+        figure_template_key() options so a cached copy is used if possible
+        '''
         fap.PlotBase.alpha = self.args.alpha
         fap.PlotBase.highlight_color = self.args.highlight_color
 
-        x_size, y_size = video_formats[self.args.format]
+        x_size, _ = video_formats[self.args.format]
 
         plt.rcParams.update({
             'font.size': get_font_size(x_size, self.args.dpi),
@@ -89,18 +134,37 @@ class Animator:
             'axes.prop_cycle': cycler('color', [self.args.plot_color])
         })
 
+        self.layout = fla.resolve(fla.make_spec(self.args.layout),
+                                  video_formats[self.args.format],
+                                  len(self.args.plots))
+
+        key = figure_template_key(self.args)
+        if key not in figure_templates:
+            self.make_figure()
+            figure_templates[key] = pickle.dumps(
+                (self.fig, self.plots, self.elevation, self.map, self.bar))
+            plt.close(self.fig)  # Only the unpickled copy is used
+
+        (self.fig, self.plots, self.elevation,
+         self.map, self.bar) = pickle.loads(figure_templates[key])
+
+    def make_figure(self):
+        '''Make the figure, axes and plots from scratch
+        '''
+        x_size, y_size = video_formats[self.args.format]
         self.fig = plt.figure(figsize=(x_size / self.args.dpi,
                                        y_size / self.args.dpi))
 
         self.setup_elevation()
-        projection = self.setup_map()
+        self.setup_map()
         self.setup_bar()
 
         # Text data
-        self.plots.append(fap.RideText(self.fig, self.args.fields))
+        self.plots.append(fap.RideText(self.fig, self.args.fields,
+                                       self.layout))
 
         if self.map:
-            self.map.plot = fap.MapPlot(self.map.axis, projection)
+            self.map.plot = fap.MapPlot(self.map.axis, self.args.projection)
             self.plots.append(self.map.plot)
 
         if self.elevation:
@@ -108,60 +172,49 @@ class Animator:
                                                     self.args.elevation_factor)
             self.plots.append(self.elevation.plot)
 
+    def load_data(self):
+        '''Read the fit files with the records needed by the plots
+        '''
         record_names = []
         for plot in self.plots:
             record_names += plot.fit_file_names
 
         # Remove duplicates
         record_names = list(dict.fromkeys(record_names))
+        smoothing = {field: (method, window)
+                     for field, method, window in self.args.smooth}
+
+        # Use compact data and small frame windows if memory is limited
+        window = 60 if self.args.max_memory else 600
         self.data_generator = fad.DataGen(
-            fad.pre_pocess_data(self.args.infile, record_names,
-                                int(self.args.offset * 3600.0)))
+            fad.pre_pocess_data([self.args.infile] + self.args.merge,
+                                record_names, int(self.args.offset * 3600.0),
+                                smoothing, dict(self.args.prefer),
+                                dict(self.args.tolerance),
+                                bool(self.args.max_memory)),
+            window, self.args.max_memory)
 
     def setup_elevation(self):
         ''' Setup Elevation plot
         '''
-        if self.args.no_elevation:
-            # Don't make the elevation plot
-            for field in ['altitude', 'grad']:  # Remove related text
-                if field in self.args.fields:
-                    self.args.fields.remove(field)
-
-        else:
-            self.elevation = Element(gspec.GridSpec(1, 1))
-            self.elevation.gridspec.update(left=0.6, right=1.0,
-                                           top=1.0, bottom=0.8)
-            self.elevation.axis = plt.subplot(self.elevation.gridspec[0, 0])
+        if not self.args.no_elevation:
+            self.elevation = self.add_element('elevation')
 
     def setup_map(self):
         '''Setup map plot
         '''
         if self.args.no_map:
-            field = 'distance'
-            if field in self.args.fields:
-                self.args.fields.remove(field)
-            return None
+            return
 
-        projection = crs.PlateCarree()
-        self.map = Element(gspec.GridSpec(1, 1))
-        self.map.gridspec.update(left=0.6, right=1.0, top=0.8, bottom=0.4)
-        self.map.axis = plt.subplot(self.map.gridspec[0, 0],
-                                    projection=projection)
-
-        return projection
+        # The positions are projected by the plot, so plain axes are used
+        self.map = self.add_element('map')
 
     def setup_bar(self):
         ''' Setup bar plot
         '''
-        self.bar = Element(gspec.GridSpec(1, 1))
-        # If horizontal, size depends on the number of bars
-        if self.args.vertical:
-            height = 0.15
-        else:
-            height = 0.05 * len(self.args.plots)
-
-        self.bar.gridspec.update(left=0.11, right=1.0, top=height, bottom=0.0)
-        self.bar.axis = plt.subplot(self.bar.gridspec[0, 0])
+        # The horizontal bar height depends on the number of bars
+        name = 'vbar' if self.args.vertical else 'bar'
+        self.bar = self.add_element(name)
 
         self.fig.patch.set_alpha(0.)  # Transparant background
         # See https://adrian.pw/blog/matplotlib-transparent-animation/
@@ -170,70 +223,171 @@ class Animator:
         for plot_variable in self.args.plots:
             plot_vars.append(fap.new_plot_var(plot_variable))
 
+        text_offset = (self.layout.get(name, 'text_dx'),
+                       self.layout.get(name, 'text_dy'))
         if self.args.vertical:
-            self.bar.gridspec.update(left=0.0, bottom=0.05, top=0.25)
-            plot_bar = fap.BarPlot(plot_vars, self.bar.axis)
+            plot_bar = fap.BarPlot(plot_vars, self.bar.axis, text_offset)
         else:
-            plot_bar = fap.HBarPlot(plot_vars, self.bar.axis)
+            plot_bar = fap.HBarPlot(plot_vars, self.bar.axis, text_offset)
 
         self.plots = [plot_bar]
 
+    def add_element(self, name):
+        '''Return a new Element with axes placed by the layout
+        '''
+        rect = self.layout.axes_rect(name)
+        return Element(rect, self.fig.add_axes(rect))
+
     def draw(self):
         '''Draw the empty plots
         '''
-        if self.map.plot:
-            self.map.plot.draw_base_plot(self.data_generator.long_list,
-                                         self.data_generator.lati_list)
+        if self.map:
+            self.map.plot.draw_base_plot(self.data_generator.longitude,
+                                         self.data_generator.latitude,
+                                         self.data_generator.position_count)
 
-        if self.elevation.plot:
+        if self.elevation:
             self.elevation.plot.draw_base_plot(
-                self.data_generator.distance_list,
-                self.data_generator.altitude_list)
-
-        # Check the dimensions of the map plot and move it to the edge/top
-        if self.map.plot:
-            dy_over_dx = self.map.plot.get_height_over_width()
-            points = self.map.gridspec[0].get_position(self.fig).get_points()
-            xmin = points[0][0]
-            ymin = points[0][1]
-            xmax = points[1][0]
-            ymax = points[1][1]
-            dx = xmax - xmin
-            dy = ymax - ymin
-            if dy_over_dx > 1.0:  # Tall. Keep gridspec height, change width
-                dx_new = dx / dy_over_dx
-                xmin_new = xmax - dx_new
-                self.map.gridspec.update(left=xmin_new)
-            else:  # Wide plot. Move up
-                # Don't scale to less that 60%... messes up for some reason
-                dy_new = dy * max(dy_over_dx, 0.6)
-                ymin_new = ymax - dy_new
-                self.map.gridspec.update(bottom=ymin_new)
+                self.data_generator.distance,
+                self.data_generator.altitude,
+                self.data_generator.elevation_count)
+
+        # Fit the map to its data and move it to the edge/top
+        if self.map:
+            self.map.rect = self.layout.fit_map(
+                self.map.plot.get_height_over_width())
+            self.map.axis.set_position(self.map.rect)
+
+        # Replace the large base tracks with images to save memory
+        if self.args.max_memory:
+            for element in [self.map, self.elevation]:
+                if element:
+                    element.plot.base = fap.rasterize(element.plot.base,
+                                                      element.axis)
+
+    def show_record(self, index):
+        '''Update the plots to show the record at index
+        '''
+        fad.run(self.data_generator.record(index), self.fig, self.plots)
+
+    def output_name(self, ending):
+        '''Return the output file name, by default based on the input name
+        '''
+        if self.args.outfile:
+            # The extension sets the container format
+            if not os.path.splitext(self.args.outfile)[1]:
+                return self.args.outfile + os.path.splitext(ending)[1]
+
+            return self.args.outfile
+
+        return (os.path.splitext(os.path.basename(
+            self.args.infile.name))[0] + ending)
 
     def animate(self):
         '''Animate the data on the plots
         '''
         number_of_frames = self.data_generator.data_set.number_of_frames()
         if self.args.num:
-            number_of_frames = self.args.num
+            number_of_frames = min(self.args.num, number_of_frames)
+
+        progress = fprog.Progress(
+            number_of_frames, self.progress_callbacks,
+            {'format': self.args.format,
+             'output': 'images' if self.args.image_sequence else 'video',
+             'profile': self.args.profile})
+
+        if self.args.show:
+            self.show(number_of_frames, progress)
+            return
+
+        fps = self.data_generator.data_set.fps
+        queue_size, writer_frames = self.queued_frames()
+        if self.args.image_sequence:
+            writer = fout.ImageSequenceWriter(
+                self.args.image_sequence, self.args.image_format,
+                self.args.compression, self.args.jobs, fps, writer_frames)
+        else:
+            profile = fout.encoder_profiles[self.args.profile]
+            writer = fout.VideoWriter(
+                self.output_name('_overlay' + profile['extension']),
+                self.fig.canvas.get_width_height(), fps, self.args.profile,
+                self.args.encoder_threads)
+
+        self.set_transparent()
+        pipeline = fpipe.Pipeline(self, writer, number_of_frames, progress,
+                                  self.args.renderers,
+                                  queue_size=queue_size,
+                                  dirty_rect=self.args.dirty_rect)
+        pipeline.run()
+
+        progress.info['stages'] = pipeline.stages
+        progress.finish()
+        if self.args.stage_stats:
+            print(f'{"stage":<10} {"frames":>7} {"busy":>6} {"starved":>8} '
+                  f'{"blocked":>8}')
+            for name, stage in pipeline.stages.items():
+                print(f'{name:<10} {stage["items"]:7d} {stage["busy"]:6.0%} '
+                      f'{stage["starved"]:8.0%} {stage["blocked"]:8.0%}')
+
+        self.print_memory()
+
+    def queued_frames(self):
+        '''Return how many rendered frames each render queue and the image
+        writer may hold. With --max-memory all of them together use at
+        most a quarter of the limit
+        '''
+        queue_size = 8
+        writer_frames = 2 * max(1, self.args.jobs)
+        if not self.args.max_memory:
+            return queue_size, writer_frames
+
+        width, height = self.fig.canvas.get_width_height()
+        frames = int(self.args.max_memory * 1024**2 / 4 / (4 * width * height))
+
+        # A queue for each renderer, and the writer
+        share = max(1, frames // (max(1, self.args.renderers) + 1))
+        return min(queue_size, share), min(writer_frames, share)
+
+    def show(self, number_of_frames, progress):
+        '''Show the animation on screen
+        '''
+        # A new counted generator each time FuncAnimation starts the frames
+        def frames():
+            return progress.frames(self.data_generator())
 
         # Time interval between frames in msec.
         inter = 1000.0 / float(self.data_generator.data_set.fps)
-        anim = animation.FuncAnimation(self.fig, fad.run, self.data_generator,
+        progress.set_stage('render')
+
+        # The animation runs while a reference is held
+        anim = animation.FuncAnimation(self.fig, fad.run, frames,
                                        fargs=(self.fig, tuple(self.plots),),
                                        repeat=False, blit=False,
                                        interval=inter,
                                        save_count=number_of_frames)
-        outf = (os.path.splitext(os.path.basename(
-            self.args.infile.name))[0] + '_overlay.mp4')
-
-        if self.args.outfile:
-            outf = self.args.outfile
+        plt.show()
+        progress.finish()
+        return anim
 
-        if not self.args.show:
-            anim.save(outf, codec="png", fps=self.data_generator.data_set.fps,
-                      savefig_kwargs={'transparent': True,
-                                      'facecolor': 'none'})
+    def set_transparent(self):
+        '''Make the figure background transparent in the rendered frames,
+        as savefig(transparent=True)
+        '''
+        self.fig.patch.set_facecolor('none')
+        for axis in self.fig.axes:
+            axis.patch.set_facecolor('none')
+            axis.patch.set_edgecolor('none')
+
+    def close(self):
+        '''Close the figure. The unpickled figures stay open in pyplot
+        until closed, so call this when the job is done
+        '''
+        if self.fig is not None:
+            plt.close(self.fig)
 
-        if self.args.show:
-            plt.show()
+    def print_memory(self):
+        '''Print the peak memory use in the memory limited mode
+        '''
+        peak = fad.peak_memory()
+        if self.args.max_memory and peak:
+            print(f'Peak memory use: {peak:.0f} MB')
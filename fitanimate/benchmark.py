@@ -0,0 +1,396 @@
+'''Golden frame checks and timing of the render paths
+
+Renders a fixed set of frames of the synthetic ride in tests/data, merged
+with its power meter file, through the reference path (full figure
+redraw) and through each optimised path, compares the pixels and times
+them. The reference frames are also compared with the golden images in
+tests/data/golden. Run from the source tree with
+
+    python -m fitanimate.benchmark
+
+The exit status is 1 if any frame differs by more than the tolerance.
+Text and line rendering change between matplotlib versions, so after an
+upgrade remake the golden images by deleting them and running again.
+'''
+import os
+import sys
+import copy
+import time
+import tempfile
+
+import numpy as np
+import matplotlib
+import configargparse
+from PIL import Image, PngImagePlugin
+
+import fitanimate.fitanimate as fa
+import fitanimate.animator as ani
+import fitanimate.data as fad
+import fitanimate.compositor as fcomp
+import fitanimate.output as fout
+import fitanimate.pipeline as fpipe
+import fitanimate.progress as fprog
+
+# The test fixtures in the source tree
+fixtures = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests', 'data')
+
+
+def load_data_set(args, low_memory=False):
+    '''Read the FIT files of args through pre_pocess_data() with the
+    records its plots need, as fitanimate does. low_memory reads them as
+    --max-memory does
+    '''
+    # The files are closed once read, so open them again
+    args = copy.copy(args)
+    args.infile = open(args.infile.name, 'rb')
+    args.merge = [open(infile.name, 'rb') for infile in args.merge]
+    args.max_memory = 1e6 if low_memory else 0.0
+
+    animator = ani.Animator(args)
+    animator.setup_figure()
+    animator.load_data()
+    animator.close()
+    for infile in [args.infile] + args.merge:
+        infile.close()
+
+    return animator.data_generator.data_set
+
+
+def make_animator(args, data_set, window=600):
+    '''Return an Animator with its plots drawn, rendering transparent
+    frames as the image sequence does
+    '''
+    animator = ani.Animator(copy.copy(args))
+    animator.setup_figure()
+    animator.data_generator = fad.DataGen(data_set, window)
+    animator.draw()
+    animator.set_transparent()
+    return animator
+
+
+def render_frames(animator, renderer, indices):
+    '''Run the frames up to the last index and return the images of the
+    indices, the render time in seconds and the number of frames rendered
+    '''
+    wanted = set(indices)
+    images = {}
+    plots = tuple(animator.plots)
+    start = time.perf_counter()
+    for number, frame in enumerate(animator.data_generator()):
+        if number > indices[-1]:
+            break
+
+        fad.run(frame, animator.fig, plots)
+        pixels = renderer.render()
+        if number in wanted:
+            images[number] = np.array(pixels)
+
+    return ([images[index] for index in indices],
+            time.perf_counter() - start, indices[-1] + 1)
+
+
+def reference(args, data_set, indices):
+    '''The full figure is drawn for every frame
+    '''
+    animator = make_animator(args, data_set)
+    result = render_frames(animator, fcomp.FullRenderer(animator.fig),
+                           indices)
+    animator.close()
+    return result
+
+
+def dirty_rect(args, data_set, indices):
+    '''Only the regions of changed artists are redrawn
+    '''
+    animator = make_animator(args, data_set)
+    compositor = fcomp.Compositor(
+        animator.fig, [artist for plot in animator.plots
+                       for artist in plot.dynamic_artists])
+    result = render_frames(animator, compositor, indices)
+    animator.close()
+    return result
+
+
+def low_memory(args, _, indices):
+    '''float32 data, small frame windows and image base tracks
+    '''
+    args = copy.copy(args)
+    args.max_memory = 1e6
+    animator = make_animator(args, load_data_set(args, True), window=60)
+    result = render_frames(animator, fcomp.FullRenderer(animator.fig),
+                           indices)
+    animator.close()
+    return result
+
+
+def keyframes(args, data_set, indices):
+    '''Records shown directly, as in the preview. Only frames of records
+    are rendered, the others are None
+    '''
+    animator = make_animator(args, data_set)
+    renderer = fcomp.FullRenderer(animator.fig)
+    fps = data_set.fps
+    images = []
+    start = time.perf_counter()
+    for index in indices:
+        if index % fps:
+            images.append(None)
+            continue
+
+        animator.show_record(index // fps)
+        images.append(np.array(renderer.render()))
+
+    animator.close()
+    rendered = sum(image is not None for image in images)
+    return images, time.perf_counter() - start, rendered
+
+
+class FrameCollector:
+    '''Pipeline writer keeping the images of the wanted frames
+    '''
+    def __init__(self, indices):
+        self.images = dict.fromkeys(indices)
+
+    @staticmethod
+    def exists(_):
+        '''All frames are rendered
+        '''
+        return False
+
+    def add(self, number, _, pixels=None, redrawn_percent=None):
+        '''Keep the pixels if the frame is wanted
+        '''
+        if number in self.images:
+            self.images[number] = pixels
+
+    def close(self):
+        '''Nothing to finish
+        '''
+
+
+def pipeline(args, data_set, indices):
+    '''The staged pipeline with two renderer processes drawing blocks of
+    frames in turn
+    '''
+    animator = make_animator(args, data_set)
+    collector = FrameCollector(indices)
+    count = indices[-1] + 1
+    start = time.perf_counter()
+    fpipe.Pipeline(animator, collector, count, fprog.Progress(count),
+                   renderers=2).run()
+    animator.close()
+    return ([collector.images[index] for index in indices],
+            time.perf_counter() - start, count)
+
+
+# Render paths compared with the reference
+modes = {
+    'dirty-rect': dirty_rect,
+    'low-memory': low_memory,
+    'keyframes': keyframes,
+    'pipeline': pipeline,
+}
+
+
+def compare(image, golden, tolerance):
+    '''Return the largest channel difference and the number of pixels
+    differing by more than tolerance
+    '''
+    difference = np.abs(image.astype(np.int16) - golden.astype(np.int16))
+    largest = difference.max(axis=2)
+    return int(largest.max()), int((largest > tolerance).sum())
+
+
+def golden_frames(directory, name, indices, images):
+    '''Return the golden images of the indices from directory and the
+    matplotlib versions that made them. Missing images are saved there
+    from images first
+    '''
+    golden = []
+    versions = set()
+    for index, image in zip(indices, images):
+        path = os.path.join(directory, f'{name}_{index:06d}.png')
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            info = PngImagePlugin.PngInfo()
+            info.add_text('matplotlib', matplotlib.__version__)
+            Image.fromarray(image, 'RGBA').save(path, pnginfo=info)
+
+        with Image.open(path) as saved:
+            versions.add(saved.text.get('matplotlib'))
+            golden.append(np.asarray(saved.convert('RGBA')))
+
+    return golden, versions
+
+
+def check(images, references, tolerance):
+    '''Return the largest channel difference and the number of bad pixels
+    of the images that were rendered (not None), or None, None if none were
+    '''
+    checks = [compare(image, reference, tolerance)
+              for image, reference in zip(images, references)
+              if image is not None]
+    if not checks:
+        return None, None
+
+    return (max(largest for largest, _ in checks),
+            sum(bad for _, bad in checks))
+
+
+def encode_profiles(images, fps, profiles):
+    '''Return (profile, encode fps, bytes per minute of video) of the
+    images encoded with each of the encoder profiles
+    '''
+    height, width, _ = images[0].shape
+    minutes = len(images) / fps / 60.0
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in profiles:
+            extension = fout.encoder_profiles[profile]['extension']
+            path = os.path.join(directory, profile + extension)
+            start = time.perf_counter()
+            writer = fout.VideoWriter(path, (width, height), fps, profile)
+            for number, image in enumerate(images):
+                writer.add(number, None, image)
+
+            writer.close()
+            seconds = time.perf_counter() - start
+            results.append((profile, len(images) / seconds,
+                            os.path.getsize(path) / minutes))
+
+    return results
+
+
+def main():
+    '''Entry point for the benchmark
+    '''
+    parser = configargparse.ArgumentParser(
+        description='Compare the optimised render paths with the reference.',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--fit', type=str, default=os.path.join(fixtures, 'ride.fit'),
+        metavar='FITFILE', help='FIT file to render.'
+    )
+    parser.add_argument(
+        '--merge', type=str, nargs='*',
+        default=[os.path.join(fixtures, 'power.fit')], metavar='FITFILE',
+        help='FIT files to merge with it.'
+    )
+    parser.add_argument(
+        '--format', '-f', type=str, default='360p',
+        choices=ani.video_formats.keys(), help='Frame resolution.'
+    )
+    parser.add_argument(
+        '--frames', type=int, nargs='+',
+        default=[0, 1, 5, 9, 10, 37, 99, 150, 299, 444, 600, 1001],
+        help='Frame indices to compare.'
+    )
+    parser.add_argument(
+        '--modes', type=str, nargs='+', default=list(modes),
+        choices=list(modes), help='Render paths to check.'
+    )
+    parser.add_argument(
+        '--tolerance', type=int, default=2,
+        help='Largest allowed difference of a pixel channel.'
+    )
+    parser.add_argument(
+        '--golden', type=str, default=os.path.join(fixtures, 'golden'),
+        metavar='DIR',
+        help='Compare the reference with the golden images in DIR, saving '
+        'any that are missing first. Only valid for the same FIT files and '
+        'options. An empty DIR skips the check.'
+    )
+    parser.add_argument(
+        '--profiles', type=str, nargs='*', default=list(fout.encoder_profiles),
+        choices=list(fout.encoder_profiles),
+        help='Video encoder profiles to time.'
+    )
+    parser.add_argument(
+        '--encode-frames', type=int, default=100,
+        help='Number of frames to encode with each profile.'
+    )
+    parser.add_argument(
+        'options', nargs=configargparse.REMAINDER,
+        help='fitanimate options for the figure, after --'
+    )
+    args = parser.parse_args()
+
+    options = [option for option in args.options if option != '--']
+    for merge in args.merge:
+        options += ['--merge', merge]
+
+    fit_args = fa.make_parser().parse_args(
+        [args.fit, '--format', args.format] + options,
+        config_file_contents='', env_vars={})
+
+    # Read the data as fitanimate does
+    animator = ani.Animator(fit_args)
+    animator.setup()
+    animator.close()
+    data_set = animator.data_generator.data_set
+
+    indices = sorted(set(index for index in args.frames
+                         if index < data_set.number_of_frames()))
+    if not indices:
+        parser.error(f'The ride has {data_set.number_of_frames()} frames, '
+                     'none of the --frames')
+
+    images, seconds, count = reference(fit_args, data_set, indices)
+    per_frame = seconds / count
+    results = [('reference', per_frame, None, None)]
+    versions = set()
+    if args.golden:
+        golden, versions = golden_frames(args.golden, args.format, indices,
+                                         images)
+        results.append(('golden', None) + check(images, golden,
+                                                args.tolerance))
+
+    for mode in args.modes:
+        mode_images, mode_seconds, count = modes[mode](fit_args, data_set,
+                                                       indices)
+        results.append((mode, mode_seconds / count if count else None) +
+                       check(mode_images, images, args.tolerance))
+
+    failed = False
+    print(f'{len(indices)} frames up to {indices[-1]} at {args.format}')
+    print(f'{"mode":<12} {"ms/frame":>9} {"speedup":>8} {"max diff":>9} '
+          f'{"bad pixels":>11}')
+    for mode, mode_per_frame, largest, bad in results:
+        timing = f'{"-":>9} {"-":>8}'
+        if mode_per_frame is not None:
+            timing = (f'{1000 * mode_per_frame:9.1f} '
+                      f'{per_frame / mode_per_frame:7.2f}x')
+
+        result = f'{"-":>9} {"-":>11}'
+        if largest is not None:
+            result = f'{largest:9d} {bad:11d}'
+            if bad:
+                result += '  FAIL'
+                failed = True
+
+        print(f'{mode:<12} {timing} {result}')
+
+    if versions - {matplotlib.__version__}:
+        print('The golden images were made with matplotlib ' +
+              ', '.join(sorted(str(version) for version in versions)) +
+              f', this is {matplotlib.__version__}')
+
+    if args.profiles and args.encode_frames > 0:
+        count = min(args.encode_frames, data_set.number_of_frames())
+        animator = make_animator(fit_args, data_set)
+        frames, _, _ = render_frames(
+            animator, fcomp.FullRenderer(animator.fig), list(range(count)))
+        animator.close()
+        print(f'\n{count} frames encoded')
+        print(f'{"profile":<18} {"encode fps":>10} {"MB/minute":>10}')
+        for profile, encode_fps, size in encode_profiles(
+                frames, data_set.fps, args.profiles):
+            print(f'{profile:<18} {encode_fps:10.1f} {size / 1e6:10.2f}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
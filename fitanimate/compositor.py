@@ -0,0 +1,141 @@
+'''Render frames by redrawing only the parts of the figure that change
+'''
+import numpy as np
+
+
+def union_area(rects):
+    '''Return the area covered by a list of (x0, y0, x1, y1) rectangles
+    '''
+    xs = sorted({x for rect in rects for x in (rect[0], rect[2])})
+    area = 0
+    for left, right in zip(xs[:-1], xs[1:]):
+        spans = sorted((rect[1], rect[3]) for rect in rects
+                       if rect[0] <= left and rect[2] >= right)
+        covered = 0
+        top = None
+        for y0, y1 in spans:
+            if top is None or y0 > top:
+                covered += y1 - y0
+                top = y1
+            elif y1 > top:
+                covered += y1 - top
+                top = y1
+
+        area += covered * (right - left)
+
+    return area
+
+
+def rgba_pixels(renderer):
+    '''Return the pixels of an Agg renderer as a height x width x 4 array.
+    Before matplotlib 3.1 buffer_rgba() returns bytes, not an array
+    '''
+    return np.frombuffer(renderer.buffer_rgba(), np.uint8).reshape(
+        int(renderer.height), int(renderer.width), 4)
+
+
+class FullRenderer:
+    '''Draw the whole figure for every frame
+    '''
+    def __init__(self, fig):
+        self.fig = fig
+
+        # Fraction of the pixels redrawn for each frame
+        self.touched = []
+
+    def render(self):
+        '''Draw the frame and return the RGBA pixels
+        '''
+        self.fig.canvas.draw()
+        self.touched.append(1.0)
+        return rgba_pixels(self.fig.canvas.get_renderer())
+
+
+class Compositor(FullRenderer):
+    '''Draw the static parts of the figure once. For each frame restore the
+    background only around the artists that changed (are stale) and redraw
+    them, and any other dynamic artists overlapping those regions, onto the
+    previous frame.
+    '''
+    # Extra pixels around each artist for antialiasing
+    pad = 2
+
+    def __init__(self, fig, artists):
+        FullRenderer.__init__(self, fig)
+        self.canvas = fig.canvas
+        self.artists = sorted(artists, key=lambda artist: artist.zorder)
+        for artist in self.artists:
+            artist.set_animated(True)
+
+        # Animated artists are not drawn
+        self.canvas.draw()
+        self.renderer = self.canvas.get_renderer()
+        self.width, self.height = self.canvas.get_width_height()
+        self.background = self.canvas.copy_from_bbox(fig.bbox)
+
+        # Pixel rectangle of each artist as last drawn
+        self.extents = {artist: None for artist in self.artists}
+        for artist in self.artists:
+            artist.stale = True
+
+    def extent(self, artist):
+        '''Return the padded pixel rectangle of the artist, or None
+        '''
+        bbox = artist.get_window_extent(self.renderer)
+        if not (np.isfinite(bbox.extents).all() and
+                (bbox.width > 0 or bbox.height > 0)):
+            return None
+
+        return (max(int(bbox.x0) - self.pad, 0),
+                max(int(bbox.y0) - self.pad, 0),
+                min(int(np.ceil(bbox.x1)) + self.pad, self.width),
+                min(int(np.ceil(bbox.y1)) + self.pad, self.height))
+
+    @staticmethod
+    def overlaps(rect, rects):
+        '''Return True if rect overlaps any of rects
+        '''
+        return any(rect[0] < other[2] and other[0] < rect[2] and
+                   rect[1] < other[3] and other[1] < rect[3]
+                   for other in rects)
+
+    def render(self):
+        '''Redraw the changed regions and return the RGBA pixels
+        '''
+        redraw = set()
+        regions = []
+        for artist in self.artists:
+            if not artist.stale:
+                continue
+
+            redraw.add(artist)
+            old = self.extents[artist]
+            self.extents[artist] = self.extent(artist)
+            regions += [rect for rect in (old, self.extents[artist]) if rect]
+
+        # Artists partly inside a restored region are redrawn completely,
+        # so their whole rectangle must be restored too
+        grown = True
+        while grown:
+            grown = False
+            for artist in self.artists:
+                rect = self.extents[artist]
+                if (artist not in redraw and rect and
+                        self.overlaps(rect, regions)):
+                    redraw.add(artist)
+                    regions.append(rect)
+                    grown = True
+
+        for x0, y0, x1, y1 in regions:
+            # Agg regions are measured from the top
+            self.canvas.restore_region(
+                self.background,
+                bbox=(x0, self.height - y1, x1, self.height - y0), xy=(0, 0))
+
+        for artist in self.artists:
+            if artist in redraw:
+                self.fig.draw_artist(artist)
+
+        self.touched.append(union_area(regions) /
+                            float(self.width * self.height))
+        return rgba_pixels(self.canvas.get_renderer())
@@ -1,8 +1,32 @@
 ''' Manange and process fit file data to be displayed
 '''
 
+import sys
+from array import array
+from bisect import bisect_right
+
+import numpy as np
 import fitparse
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Derived fields calculated by smoothing a record field.
+# name: (source field, method, window in seconds)
+smoothed_fields = {
+    'power_3s': ('power', 'mean', 3),
+    'power_10s': ('power', 'mean', 10),
+    'power_30s': ('power', 'mean', 30),
+    'power_ema': ('power', 'ema', 30),
+    'normalized_power': ('power', 'np', 30),
+}
+
+# Records further apart than this many seconds are a pause, eg. auto-pause.
+# Smoothing starts again after a pause.
+pause_gap = 10.0
+
 
 def safe_data(data, name=None):
     '''Protect against invalid input data
@@ -23,201 +47,608 @@ def safe_data(data, name=None):
     return float_data
 
 
+def pause_starts(timestamps, gap=None):
+    '''Return the index of the first record after the latest pause for
+    each record. Records more than gap seconds apart are a pause
+    '''
+    gap = pause_gap if gap is None else gap
+    start = np.ones(len(timestamps), dtype=bool)
+    start[1:] = np.diff(timestamps) > gap
+    return np.maximum.accumulate(
+        np.where(start, np.arange(len(timestamps)), 0))
+
+
+def rolling_mean(values, timestamps, window):
+    '''Trailing mean over the records of the last window seconds,
+    calculated in one pass with a cumulative sum. The mean starts again
+    after a pause, and near the start averages what is available.
+    '''
+    values = np.asarray(values, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    stop = np.arange(1, len(values) + 1)
+    start = np.maximum(np.searchsorted(timestamps, timestamps - window,
+                                       side='right'),
+                       pause_starts(timestamps))
+    return (csum[stop] - csum[start]) / (stop - start)
+
+
+def exponential_mean(values, timestamps, window):
+    '''Exponential moving average with the span of window seconds,
+    started again after a pause.
+
+    A record dt seconds after the previous one updates the average with
+    y[k] = d**dt*y[k-1] + (1 - d**dt)*x[k]. This is unrolled to a scaled
+    cumulative sum, in blocks of time so that d**-t stays finite.
+    '''
+    values = np.asarray(values, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+    result = values.copy()
+    decay = 1.0 - 2.0 / (window + 1.0)
+    if len(values) < 1 or decay <= 0.0:
+        return result
+
+    block = 100.0 / -np.log10(decay)
+    starts = pause_starts(timestamps)
+    elapsed = timestamps - timestamps[starts]
+    edges = np.flatnonzero((starts[1:] != starts[:-1]) |
+                           (elapsed[1:] // block != elapsed[:-1] // block)) + 1
+    for start, stop in zip(np.concatenate(([0], edges)).tolist(),
+                           np.concatenate((edges, [len(values)])).tolist()):
+        # Continue from the previous record, unless after a pause
+        previous = start - 1 if start > 0 and starts[start] != start else start
+        times = timestamps[start:stop] - timestamps[previous]
+        powers = decay ** times
+        weights = 1.0 - decay ** np.diff(np.concatenate(([0.0], times)))
+        result[start:stop] = powers * (
+            result[previous] +
+            np.cumsum(weights * values[start:stop] / powers))
+
+    return result
+
+
+def normalized_power(values, timestamps, window=30):
+    '''Running normalized power: the fourth root of the cumulative mean of
+    the fourth power of the rolling mean
+    '''
+    fourth = rolling_mean(values, timestamps, window)**4
+    return (np.cumsum(fourth) / np.arange(1, len(fourth) + 1))**0.25
+
+
+def great_circle_interpolate(lat0, lon0, lat1, lon1, weight):
+    '''Interpolate between positions (in degrees) along the great circles
+    joining them. weight of 0 gives the first position, 1 the second
+    '''
+    lat0, lon0, lat1, lon1 = np.radians([lat0, lon0, lat1, lon1])
+    start = np.array([np.cos(lat0) * np.cos(lon0), np.cos(lat0) * np.sin(lon0),
+                      np.sin(lat0)])
+    end = np.array([np.cos(lat1) * np.cos(lon1), np.cos(lat1) * np.sin(lon1),
+                    np.sin(lat1)])
+    angle = np.arccos(np.clip(np.sum(start * end, axis=0), -1.0, 1.0))
+
+    # Spherical linear interpolation, or linear if the points are the same
+    sin_angle = np.sin(angle)
+    same = sin_angle < 1e-12
+    sin_angle[same] = 1.0
+    weight0 = np.where(same, 1.0 - weight,
+                       np.sin((1.0 - weight) * angle) / sin_angle)
+    weight1 = np.where(same, weight, np.sin(weight * angle) / sin_angle)
+    point = weight0 * start + weight1 * end
+
+    return (np.degrees(np.arctan2(point[2], np.hypot(point[0], point[1]))),
+            np.degrees(np.arctan2(point[1], point[0])))
+
+
+smoothing_methods = {
+    'mean': rolling_mean,
+    'ema': exponential_mean,
+    'np': normalized_power,
+}
+
+
+class EventTable:
+    '''Timestamp sorted events, such as laps, with O(log n) lookup of the
+    latest event at a given time
+    '''
+    def __init__(self):
+        self.timestamps = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp, value):
+        '''Add an event. Events at the same time are kept in order
+        '''
+        index = bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(index, timestamp)
+        self.values.insert(index, value)
+
+    def index(self, timestamp):
+        '''Return the index of the latest event at or before the timestamp,
+        -1 if there is none
+        '''
+        return bisect_right(self.timestamps, timestamp) - 1
+
+    def value(self, timestamp, default=None):
+        '''Return the value of the latest event at or before the timestamp
+        '''
+        index = self.index(timestamp)
+        return self.values[index] if index >= 0 else default
+
+    def indices(self, timestamps):
+        '''Vectorised index() for an array of timestamps
+        '''
+        return np.searchsorted(np.asarray(self.timestamps, dtype=float),
+                               timestamps, side='right') - 1
+
+
 class DataSet:
     ''' Container Class for fitfile data
     '''
+    # Fields calculated from the lap events
+    lap_fields = ['lap', 'lap_time', 'last_lap']
+
     # Only iterpolated these fast changing variables
-    do_interpolate = ['power', 'speed', 'cadence']
+    do_interpolate = (['power', 'speed', 'cadence', 'distance', 'altitude',
+                       'grad'] + list(smoothed_fields))
 
-    def __init__(self):
-        self.data = []
-        self.int_data = []
+    # Interpolated along great circles
+    position_fields = ['position_lat', 'position_long']
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
         self.fps = 10
 
-    def add_data(self, data):
-        '''Add a data record
-        '''
-        if len(self.data) < 1:
-            self.data.append(data)
-            return True
+        # One entry per record. Missing data is NaN.
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.columns = {}
 
-        t_prev = int(self.data[-1]['timestamp'])
-        delta_time = int(data['timestamp']) - t_prev
-        if delta_time == 0:
-            return True
+        # Sparse data such as laps and gear changes, {name: EventTable}
+        self.events = {}
 
-        if delta_time < 0:
-            print('Negative time delta! Not adding data')
-            return False
+    def __len__(self):
+        return len(self.timestamps)
 
-        self.data.append(data)
-        return True
+    def set_column(self, name, values):
+        '''Set the data for a record variable, using NaN for missing data.
+        Positions are always float64, float32 moves map points by a pixel
+        '''
+        dtype = np.float64 if name in self.position_fields else self.dtype
+        self.columns[name] = np.asarray(values, dtype=dtype)
 
-    def interpolate_data(self):
-        '''Interpolate fast changing data to allow smooth animation
+    def add_event(self, name, timestamp, value):
+        '''Add sparse data at the timestamp
         '''
-        for i in range(len(self.data) - 1):
-            data0 = self.data[i]
-            data1 = self.data[i + 1]
-            self.int_data.append(data0)
-            for j in range(1, self.fps):
-                dnew = {}
-                for feild in data0.keys():
-                    if feild in data1 and feild in self.do_interpolate:
-                        dnew[feild] = self._interpolate(data0[feild],
-                                                        data1[feild], j)
-                        dnew['interpolated'] = True
+        self.events.setdefault(name, EventTable()).add(timestamp, value)
 
-                self.int_data.append(dnew)
+    def event_values(self, name, timestamps):
+        '''Return a list of the value of the event field at each timestamp,
+        None if there is no value. The lap fields are the lap number, the
+        time into the lap and the time of the previous lap.
+        '''
+        if name in self.lap_fields:
+            laps = self.events.get('lap', EventTable())
+            index = laps.indices(timestamps)
+            if name == 'lap':
+                return (index + 2).tolist()
+
+            # Laps end at the lap events
+            ends = np.asarray(laps.timestamps + [np.inf], dtype=float)
+            starts = np.concatenate(([self.timestamps[0]], ends[:-1]))
+            if name == 'lap_time':
+                return (timestamps - starts[index + 1]).tolist()
+
+            return [None if i < 0 else end - start for i, end, start in
+                    zip(index.tolist(), ends[index].tolist(),
+                        starts[index].tolist())]
+
+        if name not in self.events:
+            return [None] * len(timestamps)
+
+        table = self.events[name]
+        return [table.values[i] if i >= 0 else None
+                for i in table.indices(timestamps).tolist()]
+
+    def smooth(self, field, source, method='mean', window=3):
+        '''Set field to the smoothed values of the source field
+        '''
+        if source not in self.columns:
+            return
+
+        values = self.columns[source]
+        valid = ~np.isnan(values)
+        smoothed = np.full(len(values), np.nan)
+        smoothed[valid] = smoothing_methods[method](
+            values[valid], self.timestamps[valid], window)
+        self.set_column(field, smoothed)
+
+    def frame_window(self, start, stop):
+        '''Return a dictionary with an array of each record variable for
+        the frames from record start up to, not including, record stop.
+
+        There are fps frames per record. The first is the record itself,
+        the rest are interpolated towards the next record.
+        '''
+        step = np.arange((stop - start) * self.fps) % self.fps
+        index = start + np.arange((stop - start) * self.fps) // self.fps
+        weight = step / float(self.fps)
+        frames = {'timestamp': self.timestamps[index] + weight}
+        if all(name in self.columns for name in self.position_fields):
+            latitude = self.columns['position_lat']
+            longitude = self.columns['position_long']
+            frames['position_lat'], frames['position_long'] = (
+                great_circle_interpolate(latitude[index], longitude[index],
+                                         latitude[index + 1],
+                                         longitude[index + 1], weight))
+
+        for name, values in self.columns.items():
+            if name in frames:
+                continue
+
+            if name in self.do_interpolate:
+                frames[name] = self._interpolate(values[index],
+                                                 values[index + 1], weight)
+            else:
+                frames[name] = np.where(step == 0, values[index], np.nan)
+
+        return frames
 
     def number_of_frames(self):
         '''Return the total number of image frames
         '''
-        return self.fps * len(self.data)
+        return self.fps * max(len(self) - 1, 0)
 
-    def _interpolate(self, value0, value1, step):
-        '''Calculate and return an interpolated data point
+    @staticmethod
+    def _interpolate(value0, value1, weight):
+        '''Calculate and return interpolated data points
         '''
-        return ((self.fps - step) * value0 + step * value1) / float(self.fps)
+        return (1.0 - weight) * value0 + weight * value1
 
     def dump(self):
         '''Write all the data to stdout
         '''
-        for data in self.data:
-            print(data)
+        for i, timestamp in enumerate(self.timestamps.tolist()):
+            data = {name: float(values[i])
+                    for name, values in self.columns.items()
+                    if not np.isnan(values[i])}
+            for name, table in self.events.items():
+                data[name] = table.value(timestamp)
+
+            print(timestamp, data)
 
 
-def pre_pocess_data(infile, record_names, timeoffset=None) -> DataSet:
-    '''Read a fitfile and return a DataSet of data with the request records
+class FitSource:
+    '''Record data from one fitfile as timestamp sorted columns
     '''
-    dataset = DataSet()
-    fit_file = fitparse.FitFile(infile)
+    def __init__(self, infile, record_names, timeoffset=None,
+                 keep_messages=True):
+        self.record_names = [name for name in record_names
+                             if name != 'timestamp']
+
+        # Events as (timestamp of the preceding record, field name, value)
+        self.events = []
+
+        timestamps = array('q')
+        rows = array('d')
+        fit_file = fitparse.FitFile(infile)
+        for message in fit_file.get_messages(['record', 'lap', 'event']):
+            if not keep_messages:
+                # FitFile keeps every parsed message, drop them as we go
+                del fit_file._messages[:]
+
+            message_name = message.as_dict()['name']
+            if message_name == 'record':
+                timestamp = int(message.get_value('timestamp').timestamp())
+                if timeoffset:
+                    timestamp += timeoffset
+
+                timestamps.append(timestamp)
+                for feild in self.record_names:
+                    datum = safe_data(message.get_value(feild), feild)
+                    rows.append(np.nan if datum is None else datum)
+
+            elif message_name == 'lap' and len(timestamps) > 0:
+                self.events.append((timestamps[-1], 'lap', True))
+
+            elif (message_name == 'event' and
+                  message.get_raw_value('gear_change_data') and
+                  len(timestamps) > 0):
+                front_gear = message.get_value('front_gear')
+                rear_gear = message.get_value('rear_gear')
+                self.events.append((timestamps[-1], 'gears',
+                                    f"{front_gear}-{rear_gear}"))
+
+        # Sort by time, keeping the first record of any repeated timestamp
+        timestamps = np.frombuffer(timestamps, dtype=np.int64)
+        order = np.argsort(timestamps, kind='stable')
+        self.timestamps, first = np.unique(timestamps[order],
+                                           return_index=True)
+        rows = np.frombuffer(rows, dtype=float).reshape(
+            len(order), len(self.record_names))
+        rows = rows[order[first]]
+        self.columns = {name: rows[:, i]
+                        for i, name in enumerate(self.record_names)
+                        if not np.isnan(rows[:, i]).all()}
+
+    def nearest(self, timestamps, tolerance):
+        '''Return the index of the nearest record to each of the sorted
+        timestamps and whether it is within tolerance seconds
+        '''
+        if len(self.timestamps) < 1:
+            index = np.zeros(len(timestamps), dtype=int)
+            return index, np.zeros(len(timestamps), dtype=bool)
+
+        after = np.clip(np.searchsorted(self.timestamps, timestamps),
+                        0, len(self.timestamps) - 1)
+        before = np.maximum(after - 1, 0)
+        use_before = (np.abs(timestamps - self.timestamps[before]) <
+                      np.abs(self.timestamps[after] - timestamps))
+        index = np.where(use_before, before, after)
+        valid = np.abs(self.timestamps[index] - timestamps) <= tolerance
+        return index, valid
+
+
+def merge_sources(sources, priority=None, tolerance=None):
+    '''Join the sources onto the timestamps of the first source.
+
+    priority maps a field name to the index of the source to prefer for it,
+    otherwise sources are used in order. tolerance maps a field name
+    (or None for the default) to the largest allowed time difference in
+    seconds. Returns the timestamps and a dictionary of field columns.
+    '''
+    priority = priority or {}
+    tolerance = tolerance or {}
+    timestamps = sources[0].timestamps
+
+    nearest = {}
+    columns = {}
+    for name in dict.fromkeys(n for s in sources for n in s.columns):
+        order = list(range(len(sources)))
+        if name in priority:
+            order.remove(priority[name])
+            order.insert(0, priority[name])
+
+        column = np.full(len(timestamps), np.nan)
+        for i in order:
+            if name not in sources[i].columns:
+                continue
+
+            key = (i, tolerance.get(name, tolerance.get(None, 1.0)))
+            if key not in nearest:
+                nearest[key] = sources[i].nearest(timestamps, key[1])
+
+            index, valid = nearest[key]
+            values = sources[i].columns[name][index]
+            fill = np.isnan(column) & valid
+            column[fill] = values[fill]
+
+        columns[name] = column
+
+    return timestamps, columns
+
+
+def pre_pocess_data(infile, record_names, timeoffset=None,
+                    smoothing=None, priority=None,
+                    tolerance=None, low_memory=False) -> DataSet:
+    '''Read fitfiles and return a DataSet of data with the request records
+
+    infile may be a list of fitfiles. They are merged onto the records
+    of the first, see merge_sources() for priority and tolerance.
+    smoothing maps record names to (method, window) and replaces the
+    record data with its smoothed values. low_memory stores the record
+    data as float32 and does not keep the parsed fitfile messages.
+    '''
+    if not isinstance(infile, (list, tuple)):
+        infile = [infile]
+
+    # Derived fields are calculated after reading, from their source fields
+    derived = [name for name in record_names if name in smoothed_fields]
+    record_names = [name for name in record_names if name not in derived]
+    for name in derived:
+        source = smoothed_fields[name][0]
+        if source not in record_names:
+            record_names.append(source)
+
+    for name, index in (priority or {}).items():
+        if not 0 <= index < len(infile):
+            raise ValueError(f'Source {index} preferred for {name} does not '
+                             f'exist. There are {len(infile)} sources, '
+                             f'0 to {len(infile) - 1}')
+
+    sources = [FitSource(f, record_names, timeoffset, not low_memory)
+               for f in infile]
+    timestamps, columns = merge_sources(sources, priority, tolerance)
+
+    dataset = DataSet(np.float32 if low_memory else np.float64)
+    dataset.timestamps = timestamps
+    for name, column in columns.items():
+        dataset.set_column(name, column)
+
+    # Laps from the main file only, gear changes from any file
+    for i, source in enumerate(sources):
+        for timestamp, name, value in source.events:
+            if name == 'lap' and i > 0:
+                continue
+
+            dataset.add_event(name, timestamp, value)
+
+    # Smooth before interpolating. Derived fields use the raw source data.
+    for name in derived:
+        dataset.smooth(name, *smoothed_fields[name])
+
+    for name, (method, window) in (smoothing or {}).items():
+        dataset.smooth(name, name, method, window)
 
-    for message in fit_file.get_messages(['record', 'lap', 'event']):
-        data = {}
-        message_name = message.as_dict()['name']
-        if message_name == 'record':
-            data['timestamp'] = int(message.get_value('timestamp').timestamp())
-            if timeoffset:
-                data['timestamp'] += timeoffset
+    return dataset
 
-            for feild in record_names:
-                datum = safe_data(message.get_value(feild), feild)
-                if not (datum is None):
-                    data[feild] = datum
 
-            success = dataset.add_data(data)
-            if not success:
-                print('Problem adding data point. Not adding any more data.')
-                dataset.interpolate_data()
-                return dataset
+def run(frame, _, plots):
+    '''Update the plots with the frame
+    '''
+    for plot in plots:
+        plot.update(frame)
 
-        elif message_name == 'lap' and len(dataset.data) > 0:
-            # Just append to the previous data
-            dataset.data[-1]['lap'] = True
 
-        elif (message_name == 'event' and
-              message.get_raw_value('gear_change_data') and
-              len(dataset.data) > 0):
-            front_gear = message.get_value('front_gear')
-            rear_gear = message.get_value('rear_gear')
-            dataset.data[-1]['gears'] = f"{front_gear}-{rear_gear}"
+class FrameWindow:
+    '''Frame data for the records from start up to, not including, stop
 
-    dataset.interpolate_data()
-    return dataset
+    arrays maps record variable names to an array of the frame values.
+    The other attributes are lists with an entry per frame so that
+    iterating over them does not allocate.
+    '''
+    def __init__(self, data_set, start, stop):
+        self.start = start
+        self.arrays = data_set.frame_window(start, stop)
+
+        number = (stop - start) * data_set.fps
+        self.index = list(range(number))
+        self.record = [start + i // data_set.fps for i in self.index]
+        self.interpolated = [i % data_set.fps != 0 for i in self.index]
+        self.record_frames = range(0, number, data_set.fps)
+        self.data_set = data_set
+
+    def __len__(self):
+        return len(self.index)
+
+    def values(self, name):
+        '''Return a list of the frame values of name. Missing values are
+        NaN for record variables and None for events
+        '''
+        if name in self.arrays:
+            return self.arrays[name].tolist()
 
+        return self.data_set.event_values(name, self.arrays['timestamp'])
 
-def run(data, _, plots):
-    '''Update the plots with the data
+
+class Frame:
+    '''Compact record of the frame to draw. The same instance is reused
+    for every frame
     '''
-    for plot in plots:
-        plot.update(data)
+    __slots__ = ('window', 'index', 'record', 'interpolated')
+
+    def __init__(self, window=None, index=0):
+        self.window = window
+        self.index = index
+        self.record = window.record[index] if window else 0
+        self.interpolated = window.interpolated[index] if window else False
+
+
+def peak_memory():
+    '''Return the peak resident set size of this process in MB, or None
+    if it is not available on this platform
+    '''
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    scale = 1.0 / 1024.0**2 if sys.platform == 'darwin' else 1.0 / 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
 
 
 class DataGen():
     '''Yields to first argument of run()
+
+    Frames are made window records at a time so only a window of frame
+    data is held in memory. If max_memory (MB) is given a MemoryError is
+    raised if the peak memory use passes it. This is checked after each
+    window, so it stops a run that has gone over rather than preventing it.
     '''
-    def __init__(self, data_set):
+    def __init__(self, data_set, window=600, max_memory=None):
         self.data_set = data_set
+        self.window = window
+        self.max_memory = max_memory
 
-        self.altitude_list = []
-        self.distance_list = []
+        columns = data_set.columns
+        nan = np.full(len(data_set), np.nan, dtype=data_set.dtype)
+        altitude = columns.get('altitude', nan)
+        distance = columns.get('distance', nan)
+        latitude = columns.get('position_lat', nan)
+        longitude = columns.get('position_long', nan)
 
-        self.lati_list = []
-        self.long_list = []
+        elevation = ~(np.isnan(altitude) | np.isnan(distance))
+        self.altitude = altitude[elevation]
+        self.distance = distance[elevation]
 
-        for data in data_set.data:
-            if 'altitude' in data and 'distance' in data:
-                self.altitude_list.append(data['altitude'])
-                self.distance_list.append(data['distance'])
+        position = ~(np.isnan(latitude) | np.isnan(longitude))
+        self.latitude = latitude[position]
+        self.longitude = longitude[position]
 
-            if 'position_lat' in data and 'position_long' in data:
-                self.lati_list.append(data['position_lat'])
-                self.long_list.append(data['position_long'])
+        # Number of track points up to and including each record
+        self.elevation_count = np.cumsum(elevation)
+        self.position_count = np.cumsum(position)
 
-        if len(self.altitude_list) > 0:
-            self.make_gradient_data()
+        if len(self.altitude) > 0:
+            self.make_gradient_data(elevation)
 
-    def make_gradient_data(self):
+    def make_gradient_data(self, elevation, window_size=5):
         '''
         Smooth second-by-second altitude and distance data to get
         better gradient estimates
 
         Easier to do this here instead of in preProcessData()
-        since we now have the altitude and distance arrays
+        since we now have the altitude and distance arrays. elevation
+        selects the records with both.
         '''
-
-        altitude = []
-        distance = []
-        window_size = 5
-        i = 0
-        if len(self.altitude_list) != len(self.distance_list):
-            print('Warning missmatch in distance and altitude data.')
+        if len(self.altitude) < window_size + 1:
             return
 
-        while i < len(self.altitude_list) - window_size + 1:
-            altitude.append(sum(self.altitude_list[i: i + window_size]
-                                ) / window_size)
-            distance.append(sum(self.distance_list[i: i + window_size]
-                                ) / window_size)
-            i += 1
-
-        altitude_last = None
-        distance_last = None
-        gradient_last = 0.0
-        gradient = 0.0
-        gradient_list = []
-        for i, _ in enumerate(altitude):
-            if (not (distance_last is None)) and (not (altitude_last is None)):
-                delta_distance = distance[i] - distance_last
-                delta_altitude = altitude[i] - altitude_last
-                if delta_distance != 0.0:
-                    gradient = 100.0 * delta_altitude / delta_distance
-
-                else:
-                    gradient = gradient_last
-
-                gradient_list.append(gradient)
-
-            distance_last = distance[i]
-            altitude_last = altitude[i]
-            gradient_last = gradient
-
-        # Will be window_size-1 fewer entries. Pad the start.
-        for i in range(window_size):
-            gradient_list.insert(0, gradient_list[0])
-
-        # Now insert the gradient data
-        i = 0
-        for data in self.data_set.data:
-            if 'altitude' in data and 'distance' in data:
-                if i >= len(gradient_list):
-                    print('Warning grad array size data missmatch.')
-                    break
-
-                data['grad'] = gradient_list[i]
-                i += 1
+        kernel = np.ones(window_size) / window_size
+        altitude = np.convolve(self.altitude, kernel, mode='valid')
+        distance = np.convolve(self.distance, kernel, mode='valid')
+        delta_altitude = np.diff(altitude)
+        delta_distance = np.diff(distance)
+
+        # Keep the previous gradient where the distance does not change
+        moving = delta_distance != 0.0
+        gradient = np.zeros(len(delta_distance))
+        gradient[moving] = (100.0 * delta_altitude[moving] /
+                            delta_distance[moving])
+        last = np.maximum.accumulate(
+            np.where(moving, np.arange(len(moving)), -1))
+        gradient = np.where(last >= 0, gradient[np.maximum(last, 0)], 0.0)
+
+        # Will be window_size fewer entries. Pad the start.
+        gradient = np.concatenate((np.full(window_size, gradient[0]),
+                                   gradient))
+
+        grad = np.full(len(self.data_set), np.nan)
+        grad[elevation] = gradient
+        self.data_set.set_column('grad', grad)
+
+    def check_memory(self):
+        '''Raise MemoryError if the peak memory use is over max_memory
+        '''
+        peak = peak_memory()
+        if self.max_memory and peak and peak > self.max_memory:
+            raise MemoryError(f'Peak memory use {peak:.0f} MB is over the '
+                              f'limit of {self.max_memory:.0f} MB')
+
+    def record(self, index):
+        '''Return the frame of the record at index
+        '''
+        return Frame(FrameWindow(self.data_set, index, index + 1))
+
+    def windows(self, number_of_frames=None):
+        '''Yield the FrameWindows of the data set in order, only up to the
+        records of the first number_of_frames frames if given
+        '''
+        end = len(self.data_set) - 1
+        if number_of_frames is not None:
+            end = min(end, -(-number_of_frames // self.data_set.fps))
+
+        for start in range(0, end, self.window):
+            stop = min(start + self.window, end)
+            yield FrameWindow(self.data_set, start, stop)
+            self.check_memory()
 
     def __call__(self):
-        for data in self.data_set.int_data:
-            yield data
+        frame = Frame()
+        for window in self.windows():
+            frame.window = window
+
+            for index in window.index:
+                frame.index = index
+                frame.record = window.record[index]
+                frame.interpolated = window.interpolated[index]
+                yield frame
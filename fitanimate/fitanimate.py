@@ -1,15 +1,74 @@
 '''Generate animations of data from fit file data
 '''
 import os
+import sys
 from pathlib import Path
 import configargparse
 
 import fitanimate.plot as fap
+import fitanimate.layout as fla
 import fitanimate.animator as ani
+import fitanimate.preview as fpr
+import fitanimate.output as fout
+import fitanimate.progress as fprog
 
 
-def main():
-    '''Entry point for fitanimate
+def smooth_arg(value):
+    '''Parse a FIELD=[METHOD:]SECONDS smoothing option
+    '''
+    field, _, setting = value.partition('=')
+    method, _, window = setting.rpartition(':')
+    method = method or 'mean'
+    if (not field or method not in ['mean', 'ema'] or not window.isdigit()
+            or int(window) < 1):
+        raise configargparse.ArgumentTypeError(
+            f'Invalid smoothing {value}. Use FIELD=[mean|ema:]SECONDS with '
+            'at least 1 second')
+
+    return field, method, int(window)
+
+
+def prefer_arg(value):
+    '''Parse a FIELD=SOURCE source priority option
+    '''
+    field, _, source = value.partition('=')
+    if not field or not source.isdigit():
+        raise configargparse.ArgumentTypeError(
+            f'Invalid source priority {value}. Use FIELD=SOURCE')
+
+    return field, int(source)
+
+
+def tolerance_arg(value):
+    '''Parse a [FIELD=]SECONDS merge tolerance option
+    '''
+    field, _, seconds = value.rpartition('=')
+    try:
+        return field or None, float(seconds)
+
+    except ValueError as error:
+        raise configargparse.ArgumentTypeError(
+            f'Invalid tolerance {value}. Use [FIELD=]SECONDS') from error
+
+
+def layout_arg(value):
+    '''Parse an ELEMENT.KEY=VALUE layout option
+    '''
+    name, _, setting = value.partition('=')
+    element, _, key = name.partition('.')
+    try:
+        override = (element, key, fla.parse_value(setting))
+        fla.make_spec([override])
+        return override
+
+    except ValueError as error:
+        raise configargparse.ArgumentTypeError(
+            f'Invalid layout {value}. Use ELEMENT.KEY=VALUE, where positions '
+            f'may be NUMpx. {error}') from error
+
+
+def make_parser():
+    '''Return the command line and config file parser
     '''
     parser = configargparse.ArgumentParser(
         default_config_files=[
@@ -22,6 +81,22 @@ def main():
         'infile', metavar='FITFILE', type=configargparse.FileType(mode='rb'),
         help='Input .FIT file (Use - for stdin).',
     )
+    parser.add_argument(
+        '--merge', '-m', metavar='FITFILE', action='append', default=[],
+        type=configargparse.FileType(mode='rb'),
+        help='Additional .FIT file with data to merge, eg. from a power meter.'
+    )
+    parser.add_argument(
+        '--prefer', type=prefer_arg, action='append', default=[],
+        metavar='FIELD=SOURCE',
+        help='Take FIELD from this source first. 0 is FITFILE, '
+        '1 the first merged file and so on.'
+    )
+    parser.add_argument(
+        '--tolerance', type=tolerance_arg, action='append', default=[],
+        metavar='[FIELD=]SECONDS',
+        help='Largest time difference when merging data. (default: 1.0)'
+    )
     parser.add_argument(
         '--offset', type=float, default=0.0, help='Time offset (hours).'
     )
@@ -43,6 +118,12 @@ def main():
         help='Fit file variables to display as bar plot.',
         choices=fap.supported_plots
     )
+    parser.add_argument(
+        '--smooth', type=smooth_arg, action='append', default=[],
+        metavar='FIELD=[METHOD:]SECONDS',
+        help='Smooth a fit file variable with a rolling mean or EMA over '
+        'SECONDS. Smoothing starts again after a pause in the recording.'
+    )
     parser.add_argument(
         '--no-elevation', action='store_true', default=False,
         help='Disable elevation plot.'
@@ -53,6 +134,47 @@ def main():
     parser.add_argument(
         '--outfile', '-o', type=str, default=None, help='Output filename.'
     )
+    parser.add_argument(
+        '--profile', type=str, default='png',
+        choices=fout.encoder_profiles.keys(),
+        help='Video encoder settings, all keeping the transparency: '
+        + ', '.join(fout.encoder_profiles) + '.'
+    )
+    parser.add_argument(
+        '--encoder-threads', type=int, default=None, metavar='NUM',
+        help='Video encoder threads. (default: set by the profile)'
+    )
+    parser.add_argument(
+        '--image-sequence', type=str, default=None, metavar='DIR',
+        help='Save numbered transparent images to DIR instead of a video. '
+        'Existing images are kept, so an interrupted run can be continued.'
+    )
+    parser.add_argument(
+        '--image-format', type=str, default='png',
+        choices=fout.ImageSequenceWriter.image_formats,
+        help='Image sequence file format. WebP is lossless.'
+    )
+    parser.add_argument(
+        '--compression', type=int, default=6, choices=range(10),
+        metavar='{0..9}',
+        help='Image sequence compression level. Higher is smaller and slower.'
+    )
+    parser.add_argument(
+        '--projection', type=str, default='platecarree',
+        choices=fap.map_projections,
+        help='Map projection. UTM uses the zone of the centre of the track.'
+    )
+    parser.add_argument(
+        '--dirty-rect', action='store_true',
+        help='Only redraw the parts of the frame that change and print how '
+        'much of each frame was redrawn.'
+    )
+    parser.add_argument(
+        '--layout', type=layout_arg, action='append', default=[],
+        metavar='ELEMENT.KEY=VALUE',
+        help='Change the layout, eg. map.top=0.9 or text.x=40px. Elements: '
+        + ', '.join(fla.default_layout) + '.'
+    )
     parser.add_argument(
         '--format', '-f', type=str, default='1080p',
         choices=ani.video_formats.keys(),
@@ -85,16 +207,80 @@ def main():
         '--elevation-factor', '-e', type=float, default=5.0,
         help='Scale the elevation by this factor in the plot.'
     )
+    parser.add_argument(
+        '--max-memory', type=float, default=0.0, metavar='MB',
+        help='Limit memory use for very long activities. Uses compact '
+        'data and image base tracks, and fewer frames wait to be written. '
+        'Stops if the peak use passes MB.'
+    )
+    parser.add_argument(
+        '--preview', '-p', action='store_true',
+        help='Save a 360p contact sheet of key frames, eg. maximum power '
+        'and highest point, instead of the animation.'
+    )
+    parser.add_argument(
+        '--preview-count', type=int, default=12, metavar='NUM',
+        help='Number of key frames in the preview.'
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='Number of processes to use.'
+    )
+    parser.add_argument(
+        '--renderers', type=int, default=1,
+        help='Number of processes drawing frames, each with its own figure.'
+    )
+    parser.add_argument(
+        '--stage-stats', action='store_true',
+        help='Print how busy the data, render and encode stages were.'
+    )
+    parser.add_argument(
+        '--no-progress', action='store_true',
+        help='Don\'t show the progress bar on a terminal.'
+    )
+    parser.add_argument(
+        '--progress-fd', type=int, default=None, metavar='FD',
+        help='Write progress reports as JSON lines to file descriptor FD.'
+    )
     parser.add_argument(
         '--test', '-t', action='store_true',
         help='Options for quick tests. Equivalent to "-s -f 360p".'
     )
+    return parser
+
+
+def main():
+    '''Entry point for fitanimate
+    '''
+    parser = make_parser()
     args = parser.parse_args()
+    for field, source in args.prefer:
+        if source > len(args.merge):
+            merged = ''
+            if args.merge:
+                merged = f' and 1 to {len(args.merge)} the --merge files'
+            parser.error(f'--prefer {field}={source}: there is no source '
+                         f'{source}. 0 is FITFILE{merged}.')
 
     animator = ani.Animator(args)
-    animator.setup()
-    animator.draw()
-    animator.animate()
+    try:
+        animator.setup()
+        if args.preview:
+            fpr.preview(animator, args.preview_count, args.jobs)
+            return
+
+        if sys.stderr.isatty() and not args.no_progress:
+            animator.progress_callbacks.append(fprog.TerminalBar())
+
+        if args.progress_fd is not None:
+            animator.progress_callbacks.append(
+                fprog.JsonLines(args.progress_fd))
+
+        animator.draw()
+        animator.animate()
+
+    finally:
+        animator.close()
 
 
 if __name__ == '__main__':
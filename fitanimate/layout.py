@@ -0,0 +1,157 @@
+'''Declarative layout of the overlay elements
+
+The layout spec maps each element to its settings. Positions are
+fractions of the figure, or pixels if given as eg. '40px'. A spec is
+resolved once for a video format into pixel positions, which are
+cached and used to place every element.
+'''
+import copy
+
+# Positions are fractions of the figure width (x) or height (y).
+# bar.row_height sets the top of the horizontal bars from their number.
+# map.min_height limits how much a wide map is shrunk.
+# The bar text offsets are in bar plot data units.
+default_layout = {
+    'elevation': {'left': 0.6, 'right': 1.0, 'top': 1.0, 'bottom': 0.8},
+    'map': {'left': 0.6, 'right': 1.0, 'top': 0.8, 'bottom': 0.4,
+            'min_height': 0.6},
+    'bar': {'left': 0.11, 'right': 1.0, 'bottom': 0.0, 'row_height': 0.05,
+            'text_dx': 0.01, 'text_dy': -0.28},
+    'vbar': {'left': 0.0, 'right': 1.0, 'top': 0.25, 'bottom': 0.05,
+             'text_dx': -0.12, 'text_dy': 0.05},
+    'text': {'x': 0.02, 'y': 0.95, 'dx': 0.0, 'dy': -0.06},
+    'altitude_text': {'x': 0.9, 'y': 0.95},
+    'distance_text': {'y': 0.75},
+}
+
+x_keys = ['left', 'right', 'x', 'dx']
+y_keys = ['top', 'bottom', 'y', 'dy', 'row_height']
+
+# Keys an element uses that have no default value. The bar top is set by
+# the row height and the distance text x follows the text above it.
+optional_keys = {'bar': ['top'], 'distance_text': ['x']}
+
+# Resolved layouts, keyed by the spec, figure size and number of bars
+layouts = {}
+
+
+def parse_value(value):
+    '''Return a layout value: a float fraction or a 'NUMpx' string
+    '''
+    value = value.strip()
+    if value.endswith('px'):
+        float(value[:-2])  # Check the number
+        return value
+
+    return float(value)
+
+
+def make_spec(overrides=()):
+    '''Return the default layout with the (element, key, value) overrides
+    '''
+    spec = copy.deepcopy(default_layout)
+    for element, key, value in overrides:
+        if element not in spec:
+            raise ValueError(f'Illegal layout element {element}. Must be one '
+                             'of: ' + ', '.join(spec))
+
+        keys = list(spec[element]) + optional_keys.get(element, [])
+        if key not in keys:
+            raise ValueError(f'Illegal layout key {element}.{key}. Must be '
+                             'one of: ' + ', '.join(keys))
+
+        if isinstance(value, str) and key not in x_keys + y_keys:
+            raise ValueError(f'{element}.{key} is not a position, it can not '
+                             'be in pixels')
+
+        spec[element][key] = value
+
+    return spec
+
+
+def resolve(spec, size, bar_rows=1):
+    '''Return the cached Layout of spec for a figure size (pixels)
+    '''
+    key = (tuple((element, tuple(sorted(values.items())))
+                 for element, values in sorted(spec.items())),
+           tuple(size), bar_rows)
+    if key not in layouts:
+        layouts[key] = Layout(spec, size, bar_rows)
+
+    return layouts[key]
+
+
+class Layout:
+    '''A layout spec resolved into pixels for a figure size
+    '''
+    def __init__(self, spec, size, bar_rows=1):
+        self.width, self.height = size
+
+        # {element: {key: value}} with positions in pixels
+        self.pixels = {}
+        for element, values in spec.items():
+            self.pixels[element] = {
+                key: self.to_pixels(key, value)
+                for key, value in values.items()}
+
+        bar = self.pixels['bar']
+        bar.setdefault('top', bar['bottom'] + bar['row_height'] * bar_rows)
+
+        # Pixel rectangles (x0, y0, x1, y1), y from the bottom
+        self.rects = {element: (values['left'], values['bottom'],
+                                values['right'], values['top'])
+                      for element, values in self.pixels.items()
+                      if all(key in values
+                             for key in ['left', 'bottom', 'right', 'top'])}
+
+    def to_pixels(self, key, value):
+        '''Return a position value in pixels. Other values are unchanged
+        '''
+        if key in x_keys:
+            scale = self.width
+        elif key in y_keys:
+            scale = self.height
+        else:
+            return value
+
+        if isinstance(value, str):
+            return float(value[:-2])
+
+        return value * scale
+
+    def get(self, element, key, default=None):
+        '''Return a value with positions as figure fractions
+        '''
+        value = self.pixels[element].get(key)
+        if value is None:
+            return default
+
+        if key in x_keys:
+            return value / self.width
+
+        if key in y_keys:
+            return value / self.height
+
+        return value
+
+    def axes_rect(self, element):
+        '''Return [left, bottom, width, height] of the element as figure
+        fractions, for Figure.add_axes()
+        '''
+        x0, y0, x1, y1 = self.rects[element]
+        return [x0 / self.width, y0 / self.height,
+                (x1 - x0) / self.width, (y1 - y0) / self.height]
+
+    def fit_map(self, height_over_width):
+        '''Return the map axes rect fitted to the map data. A tall map
+        keeps its height and moves right, a wide map keeps its width and
+        moves up
+        '''
+        left, bottom, width, height = self.axes_rect('map')
+        if height_over_width > 1.0:
+            new_width = width / height_over_width
+            return [left + width - new_width, bottom, new_width, height]
+
+        new_height = height * max(height_over_width,
+                                  self.get('map', 'min_height'))
+        return [left, bottom + height - new_height, width, new_height]
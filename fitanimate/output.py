@@ -0,0 +1,170 @@
+'''Write rendered frames to files
+'''
+import os
+import json
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+import matplotlib.pyplot as plt
+
+
+class ImageSequenceWriter:
+    '''Write frames as numbered, transparent, PNG or lossless WebP images.
+
+    The images are compressed by a pool of threads (Pillow releases the GIL
+    while encoding). Frames that already have an image are not written
+    again, so an interrupted run can be continued. A manifest.json with the
+    timestamp of each frame, and how much of it was redrawn if known, is
+    written on close().
+    '''
+    image_formats = ['png', 'webp']
+
+    def __init__(self, directory, image_format='png', compression=6,
+                 jobs=4, fps=10, max_pending=None):
+        if image_format not in self.image_formats:
+            raise ValueError(f'Illegal image format {image_format}. Must be '
+                             'one of: ' + ', '.join(self.image_formats))
+
+        self.directory = directory
+        self.image_format = image_format
+        self.compression = compression
+        self.fps = fps
+
+        self.pool = ThreadPoolExecutor(max(1, jobs))
+        # Limits the frames in memory
+        self.max_pending = max_pending or 2 * max(1, jobs)
+        self.pending = deque()
+        self.frames = []
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def file_name(self, number):
+        '''Return the file name of frame number
+        '''
+        return f'frame_{number:06d}.{self.image_format}'
+
+    def exists(self, number):
+        '''Return True if frame number has already been written
+        '''
+        return os.path.exists(os.path.join(self.directory,
+                                           self.file_name(number)))
+
+    def add(self, number, timestamp, pixels=None, redrawn_percent=None):
+        '''Add frame number to the manifest and compress the RGBA pixels,
+        unless the image already exists
+        '''
+        frame = {'frame': number, 'file': self.file_name(number),
+                 'timestamp': timestamp}
+        if redrawn_percent is not None:
+            frame['redrawn_percent'] = redrawn_percent
+
+        self.frames.append(frame)
+        if pixels is None or self.exists(number):
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+
+        path = os.path.join(self.directory, self.file_name(number))
+        self.pending.append(self.pool.submit(self.save, path, pixels))
+
+    def save(self, path, pixels):
+        '''Compress the pixels to path
+        '''
+        image = Image.fromarray(pixels, 'RGBA')
+
+        # Write to a temporary file so that only complete images exist
+        temp_path = path + '.part'
+        if self.image_format == 'png':
+            image.save(temp_path, 'PNG', compress_level=self.compression)
+        else:
+            image.save(temp_path, 'WEBP', lossless=True,
+                       method=min(self.compression, 6))
+
+        os.replace(temp_path, path)
+
+    def close(self):
+        '''Wait for the images to be written and write the manifest
+        '''
+        while self.pending:
+            self.pending.popleft().result()
+
+        self.pool.shutdown()
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as out:
+            json.dump({'fps': self.fps, 'frames': self.frames}, out, indent=1)
+
+
+# Video encoder settings. threads is the ffmpeg encoder thread count,
+# 0 lets ffmpeg choose.
+encoder_profiles = {
+    # PNG frames in an MP4, the original output
+    'png': {'codec': 'png', 'pix_fmt': 'rgba', 'extension': '.mp4',
+            'threads': 0, 'options': []},
+    # QuickTime Animation. Run length coding suits the mostly unchanged
+    # overlay: quick to encode and small. For editing. Not threaded.
+    'fast-intermediate': {'codec': 'qtrle', 'pix_fmt': 'argb',
+                          'extension': '.mov', 'threads': 1, 'options': []},
+    # FFV1 with per slice checksums, for keeping
+    'archive-lossless': {'codec': 'ffv1', 'pix_fmt': 'bgra',
+                         'extension': '.mkv', 'threads': 4,
+                         'options': ['-level', '3', '-g', '1',
+                                     '-slices', '4', '-slicecrc', '1']},
+    # Lossy VP9 with alpha for browsers
+    'web-alpha': {'codec': 'libvpx-vp9', 'pix_fmt': 'yuva420p',
+                  'extension': '.webm', 'threads': 4,
+                  'options': ['-b:v', '0', '-crf', '32', '-deadline', 'good',
+                              '-cpu-used', '4', '-row-mt', '1',
+                              '-auto-alt-ref', '0']},
+}
+
+
+class VideoWriter:
+    '''Write frames to a video by piping the raw RGBA pixels to ffmpeg,
+    which encodes them in its own process with the settings of one of
+    the encoder_profiles
+    '''
+    def __init__(self, path, size, fps=10, profile='png', threads=None):
+        if profile not in encoder_profiles:
+            raise ValueError(f'Illegal encoder profile {profile}. Must be '
+                             'one of: ' + ', '.join(encoder_profiles))
+
+        settings = encoder_profiles[profile]
+        if threads is None:
+            threads = settings['threads']
+
+        self.path = path
+        width, height = size
+        self.process = subprocess.Popen(
+            [plt.rcParams['animation.ffmpeg_path'], '-y',
+             '-loglevel', 'error', '-f', 'rawvideo', '-vcodec', 'rawvideo',
+             '-s', f'{width}x{height}', '-pix_fmt', 'rgba', '-r', str(fps),
+             '-i', 'pipe:', '-vcodec', settings['codec'],
+             '-pix_fmt', settings['pix_fmt'], '-threads', str(threads)] +
+            settings['options'] + [path],
+            stdin=subprocess.PIPE)
+
+    @staticmethod
+    def exists(_):
+        '''Frames are always written
+        '''
+        return False
+
+    def add(self, _, __, pixels=None, redrawn_percent=None):
+        '''Write the RGBA pixels of the next frame
+        '''
+        try:
+            self.process.stdin.write(pixels.tobytes())
+
+        except BrokenPipeError as error:  # ffmpeg stopped, see its output
+            raise subprocess.CalledProcessError(
+                self.process.wait(), self.process.args) from error
+
+    def close(self):
+        '''Finish the video
+        '''
+        self.process.stdin.close()
+        if self.process.wait():
+            raise subprocess.CalledProcessError(self.process.returncode,
+                                                self.process.args)
@@ -0,0 +1,334 @@
+'''Render the animation in stages connected by bounded queues
+
+    data:   a thread making the frame windows
+    render: the main thread, or several processes each with a copy of
+            the figure drawing interleaved blocks of frames
+    encode: a thread passing the frames in order to the writer
+
+A full queue blocks the stage feeding it, so the slowest stage sets the
+frame rate while the others run alongside it. Each stage records the
+time it spends working, waiting for input (starved) and waiting for room
+in its output queue (blocked).
+'''
+import copy
+import time
+import queue
+import threading
+import multiprocessing
+
+import numpy as np
+
+import fitanimate.data as fad
+import fitanimate.compositor as fcomp
+
+
+class Aborted(Exception):
+    '''Another stage failed
+    '''
+
+
+class Stage:
+    '''Timing of a pipeline stage
+    '''
+    def __init__(self, name, abort):
+        self.name = name
+        self.abort = abort
+        self.items = 0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.start = time.perf_counter()
+        self.stop = None
+
+        # Optional function returning False if the source has stopped
+        self.alive = None
+
+    def get(self, source):
+        '''Return the next item from the source queue
+        '''
+        start = time.perf_counter()
+        while True:
+            try:
+                item = source.get(timeout=0.1)
+                break
+
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise Aborted(self.name)
+
+                if self.alive and not self.alive():
+                    raise RuntimeError(f'{self.name}: input stopped')
+
+        self.starved += time.perf_counter() - start
+        return item
+
+    def put(self, sink, item):
+        '''Put item in the sink queue, waiting for room
+        '''
+        start = time.perf_counter()
+        while True:
+            try:
+                sink.put(item, timeout=0.1)
+                break
+
+            except queue.Full:
+                if self.abort.is_set():
+                    raise Aborted(self.name)
+
+        self.blocked += time.perf_counter() - start
+
+    def finish(self):
+        '''Stop the clock
+        '''
+        self.stop = time.perf_counter()
+
+    def utilisation(self):
+        '''Return the items done and the fractions of the time busy,
+        starved and blocked
+        '''
+        elapsed = max((self.stop or time.perf_counter()) - self.start, 1e-9)
+        busy = elapsed - self.starved - self.blocked
+        return {'items': self.items, 'seconds': round(elapsed, 2),
+                'busy': round(busy / elapsed, 3),
+                'starved': round(self.starved / elapsed, 3),
+                'blocked': round(self.blocked / elapsed, 3)}
+
+
+def run_stage(function, stage, errors, *args):
+    '''Run a stage function in a thread, recording any error and
+    stopping the other stages
+    '''
+    try:
+        function(stage, *args)
+
+    except Aborted:
+        pass
+
+    except BaseException as error:
+        errors.append(error)
+        stage.abort.set()
+
+    stage.finish()
+
+
+def produce(stage, data_generator, sink, number_of_frames):
+    '''Put the frame windows up to number_of_frames in sink
+    '''
+    for window in data_generator.windows(number_of_frames):
+        stage.put(sink, window)
+        stage.items += min(len(window), number_of_frames - stage.items)
+
+
+def make_renderer(animator, dirty_rect=False):
+    '''Return the renderer of the animator figure
+    '''
+    if dirty_rect:
+        return fcomp.Compositor(
+            animator.fig, [artist for plot in animator.plots
+                           for artist in plot.dynamic_artists])
+
+    return fcomp.FullRenderer(animator.fig)
+
+
+def render(stage, animator, renderer, windows, sink, number_of_frames,
+           skip=(), worker=0, workers=1, block=1):
+    '''Update the plots for every frame. For the frames in this worker's
+    blocks put (number, timestamp, pixels, touched) in sink, where touched
+    is the fraction of the pixels redrawn. pixels and touched are None
+    for frames in skip
+    '''
+    plots = tuple(animator.plots)
+    frame = fad.Frame()
+    number = 0
+    while number < number_of_frames:
+        window = stage.get(windows)
+        timestamps = window.arrays['timestamp']
+        frame.window = window
+        for index in window.index[:number_of_frames - number]:
+            frame.index = index
+            frame.record = window.record[index]
+            frame.interpolated = window.interpolated[index]
+            fad.run(frame, animator.fig, plots)
+
+            if (number // block) % workers == worker:
+                pixels = touched = None
+                if number not in skip:
+                    pixels = np.array(renderer.render())
+                    touched = renderer.touched[-1]
+
+                stage.put(sink, (number, float(timestamps[index]), pixels,
+                                 touched))
+                stage.items += 1
+
+            number += 1
+
+
+def render_worker(animator, number_of_frames, skip, worker, workers, block,
+                  sink, abort, dirty_rect):
+    '''Render the worker's blocks of frames in its own process, then put
+    its stage timings in sink
+    '''
+    try:
+        errors = []
+        data = Stage(f'data {worker}', abort)
+        windows = queue.Queue(2)
+        thread = threading.Thread(
+            target=run_stage,
+            args=(produce, data, errors, animator.data_generator, windows,
+                  number_of_frames))
+        thread.start()
+
+        stage = Stage(f'render {worker}', abort)
+        renderer = make_renderer(animator, dirty_rect)
+        render(stage, animator, renderer, windows, sink, number_of_frames,
+               skip, worker, workers, block)
+        stage.finish()
+        thread.join()
+        if errors:
+            raise errors[0]
+
+        sink.put({data.name: data.utilisation(),
+                  stage.name: stage.utilisation()})
+
+    except Aborted:
+        pass
+
+    except BaseException:
+        abort.set()
+        raise
+
+
+class Pipeline:
+    '''Render number_of_frames of the animator's figure and pass them to
+    the writer (see fitanimate.output) with renderers processes drawing
+    blocks of block frames in turn
+    '''
+    def __init__(self, animator, writer, number_of_frames, progress,
+                 renderers=1, block=8, queue_size=8, dirty_rect=False):
+        self.animator = animator
+        self.writer = writer
+        self.number_of_frames = number_of_frames
+        self.progress = progress
+        self.renderers = max(1, renderers)
+        self.block = block
+        self.queue_size = queue_size
+        self.dirty_rect = dirty_rect
+
+        # {stage name: utilisation()} and, with dirty_rect, the fraction of
+        # the pixels redrawn for each rendered frame
+        self.stages = {}
+        self.touched = []
+
+    def encode(self, stage, sources):
+        '''Pass the frames from the render queues to the writer in order.
+        With dirty_rect the percentage of each frame redrawn is passed to
+        the writer and the progress reports
+        '''
+        for number in range(self.number_of_frames):
+            source = sources[(number // self.block) % len(sources)]
+            _, timestamp, pixels, touched = stage.get(source)
+            redrawn = {}
+            if self.dirty_rect and touched is not None:
+                self.touched.append(touched)
+                redrawn = {'redrawn_percent': round(100.0 * touched, 2)}
+
+            self.writer.add(number, timestamp, pixels, **redrawn)
+            stage.items += 1
+            self.progress.update(number + 1, **redrawn)
+
+        # Wait for the writer to finish, eg. compressing the last images
+        self.progress.set_stage('encode')
+        self.writer.close()
+
+    def run(self):
+        '''Render and write all the frames
+        '''
+        skip = {number for number in range(self.number_of_frames)
+                if self.writer.exists(number)}
+
+        self.progress.set_stage('render')
+        if self.renderers > 1:
+            self.run_processes(skip)
+        else:
+            self.run_threads(skip)
+
+        if self.dirty_rect and self.touched:
+            print(f'Redrawn pixels per frame: '
+                  f'mean {100 * np.mean(self.touched):.1f}%, '
+                  f'max {100 * np.max(self.touched):.1f}%')
+
+    def run_threads(self, skip):
+        '''Data and encode threads with rendering in this thread
+        '''
+        abort = threading.Event()
+        errors = []
+        windows = queue.Queue(2)
+        frames = queue.Queue(self.queue_size)
+
+        data = Stage('data', abort)
+        data_thread = threading.Thread(
+            target=run_stage,
+            args=(produce, data, errors, self.animator.data_generator,
+                  windows, self.number_of_frames))
+        encode = Stage('encode', abort)
+        encode_thread = threading.Thread(
+            target=run_stage,
+            args=(lambda stage: self.encode(stage, [frames]), encode, errors))
+        data_thread.start()
+        encode_thread.start()
+
+        stage = Stage('render', abort)
+        renderer = make_renderer(self.animator, self.dirty_rect)
+        run_stage(render, stage, errors, self.animator, renderer, windows,
+                  frames, self.number_of_frames, skip)
+
+        data_thread.join()
+        encode_thread.join()
+        if errors:
+            raise errors[0]
+
+        self.stages = {stage.name: stage.utilisation()
+                       for stage in [data, stage, encode]}
+
+    def run_processes(self, skip):
+        '''Renderer processes, each with its own data thread, and an
+        encode thread
+        '''
+        context = multiprocessing.get_context()
+        abort = context.Event()
+        sources = [context.Queue(self.queue_size)
+                   for _ in range(self.renderers)]
+
+        # Open files can't be passed to other processes
+        animator = copy.copy(self.animator)
+        animator.args = copy.copy(animator.args)
+        animator.args.infile = None
+        animator.args.merge = []
+        animator.progress_callbacks = []
+
+        workers = [context.Process(
+            target=render_worker,
+            args=(animator, self.number_of_frames, skip, worker,
+                  self.renderers, self.block, sources[worker], abort,
+                  self.dirty_rect), daemon=True)
+                   for worker in range(self.renderers)]
+        for worker in workers:
+            worker.start()
+
+        errors = []
+        encode = Stage('encode', abort)
+        encode.alive = lambda: not any(worker.exitcode for worker in workers)
+        run_stage(lambda stage: self.encode(stage, sources), encode, errors)
+        if not errors and not abort.is_set():
+            for source in sources:
+                self.stages.update(encode.get(source))
+
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise errors[0]
+
+        if abort.is_set() or any(worker.exitcode for worker in workers):
+            raise RuntimeError('A renderer process failed')
+
+        self.stages[encode.name] = encode.utilisation()
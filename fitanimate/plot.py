@@ -1,7 +1,14 @@
 ''' Classes to display and animate fit file data
 '''
 from datetime import datetime
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import RendererAgg
+from cartopy import crs
+
+import fitanimate.layout as fla
+import fitanimate.compositor as fcomp
+import fitanimate.progress as fprog
 
 
 class TextLine:
@@ -19,45 +26,60 @@ class TextLine:
 
         self.fig_txt = None
 
-    def set_axes_text(self):
+        # Text for each frame of the current window, None for no change
+        self.texts = []
+
+    def set_axes_text(self, text):
         '''Sets the text
         '''
         if not self.fig_txt:
-            self.fig_txt = self.fig.text(self.x, self.y,
-                                         self.txt_format.format(self.value))
+            self.fig_txt = self.fig.text(self.x, self.y, text)
             return
 
-        self.fig_txt.set_text(self.txt_format.format(self.value))
+        self.fig_txt.set_text(text)
 
-    def set_value(self, data):
-        '''Sets the data value
+    def get_text(self, value):
+        '''Sets the data value and returns the text, or None if the value
+        is missing
         '''
-        # Don't update the text data if it is just a subsecond interpolation
-        if 'interpolated' in data and data['interpolated']:
-            return False
+        # x != x is True for NaN, the missing data
+        if value is None or value != value:
+            return None
 
-        if not (self.field_name in data):
-            return False
-
-        self.value = data[self.field_name]
+        self.value = value
         if self.scale:
             self.value *= self.scale
 
-        return True
+        return self.format_value(self.value)
 
+    def format_value(self, value):
+        '''Return the text of a value that is not missing
+        '''
+        return self.txt_format.format(value)
 
-class CounterTextLine(TextLine):
-    '''Text line consisting of an incrementing counter
-    '''
-    def __init__(self, fig, field_name, txt_format, x=None, y=None):
-        TextLine.__init__(self, fig, field_name, txt_format, x, y)
+    def prepare(self, window):
+        '''Make the text for each frame in the window
+        '''
+        values = window.values(self.field_name)
+        self.texts = [None] * len(window)
 
-    def set_value(self, data):
-        if self.value == 0 or self.field_name in data:
-            self.value += 1
-            return True
+        # Don't update the text data if it is just a subsecond interpolation
+        for i in window.record_frames:
+            self.texts[i] = self.get_text(values[i])
 
-        return False
+    def update(self, index):
+        '''Show the text of frame index of the window
+        '''
+        text = self.texts[index]
+        if text is not None:
+            self.set_axes_text(text)
+
+
+class DurationTextLine(TextLine):
+    '''Text line showing a number of seconds as [H:]MM:SS
+    '''
+    def format_value(self, value):
+        return self.txt_format.format(fprog.duration(value))
 
 
 class TSTextLine(TextLine):
@@ -68,13 +90,13 @@ class TSTextLine(TextLine):
         TextLine.__init__(self, fig, field_name, txt_format, x, y)
         self.timeformat = timeformat
 
-    def set_value(self, data):
-        if not TextLine.set_value(self, data):
-            return False
+    def get_text(self, value):
+        if value is None or value != value:
+            return None
 
-        self.value = (datetime.fromtimestamp(int(self.value))
+        self.value = (datetime.fromtimestamp(int(value))
                       .strftime(self.timeformat))
-        return True
+        return self.txt_format.format(self.value)
 
 
 class TextPlot:
@@ -87,6 +109,9 @@ class TextPlot:
         # List of fit file record variable names requred for this plot
         self._fit_file_names = []
 
+        # The frame window the text lines are prepared for
+        self.window = None
+
         # Postion of first text object if not specified
         self.x = 0.02
         self.y = 0.95
@@ -114,6 +139,8 @@ class TextPlot:
         if text_line.y is None:
             text_line.y = yprev + self.dy
 
+        # Create the text now so it exists before the first frame
+        text_line.set_axes_text('')
         self.text_lines.append(text_line)
 
         self._fit_file_names.append(text_line.field_name)
@@ -124,28 +151,49 @@ class TextPlot:
         '''
         return self._fit_file_names
 
-    def update(self, data):
+    @property
+    def dynamic_artists(self):
+        '''Returns list of artists changed by update
+        '''
+        return [text_line.fig_txt for text_line in self.text_lines]
+
+    def update(self, frame):
         '''Updates the text
         '''
-        for text_line in self.text_lines:
+        if frame.interpolated:
+            return
 
-            if not text_line.set_value(data):
-                continue
+        if frame.window is not self.window:
+            self.window = frame.window
+            for text_line in self.text_lines:
+                text_line.prepare(self.window)
 
-            text_line.set_axes_text()
+        for text_line in self.text_lines:
+            text_line.update(frame.index)
 
 
 class RideText(TextPlot):
     '''Container for text to be displayed
     '''
     supported_fields = ['timestamp', 'temperature', 'core_temperature',
-                        'heart_rate', 'lap', 'gears', 'altitude', 'grad',
-                        'distance']
+                        'heart_rate', 'lap', 'lap_time', 'last_lap', 'gears',
+                        'altitude', 'grad', 'distance', 'power_3s',
+                        'power_10s', 'power_30s', 'power_ema',
+                        'normalized_power']
 
-    def __init__(self, fig, fields):
+    def __init__(self, fig, fields, layout=None):
         TextPlot.__init__(self, fig)
         self.fields = fields
 
+        if layout is None:
+            layout = fla.resolve(fla.make_spec(),
+                                 fig.canvas.get_width_height())
+
+        self.x = layout.get('text', 'x')
+        self.y = layout.get('text', 'y')
+        self.dx = layout.get('text', 'dx')
+        self.dy = layout.get('text', 'dy')
+
         if 'timestamp' in self.fields:
             self.add_text_line(TSTextLine(self.fig, 'timestamp', '{}'))
 
@@ -160,21 +208,40 @@ class RideText(TextPlot):
             self.add_text_line(TextLine(self.fig, 'heart_rate', '{:.0f} BPM'))
 
         if 'lap' in self.fields:
-            self.add_text_line(CounterTextLine(self.fig, 'lap', 'Lap {}'))
+            self.add_text_line(TextLine(self.fig, 'lap', 'Lap {}'))
+
+        if 'lap_time' in self.fields:
+            self.add_text_line(DurationTextLine(self.fig, 'lap_time',
+                                                'Lap time {}'))
+
+        if 'last_lap' in self.fields:
+            self.add_text_line(DurationTextLine(self.fig, 'last_lap',
+                                                'Last lap {}'))
 
         if 'gears' in self.fields:
             self.add_text_line(TextLine(self.fig, 'gears', '{}'))
 
+        for field, label in [('power_3s', '3s'), ('power_10s', '10s'),
+                             ('power_30s', '30s'), ('power_ema', 'EMA'),
+                             ('normalized_power', 'NP')]:
+            if field in self.fields:
+                self.add_text_line(TextLine(self.fig, field,
+                                            label + ' {:.0f} W'))
+
         # Position near the elevation profile
         if 'altitude' in self.fields or 'grad' in self.fields:
-            self.add_text_line(TextLine(self.fig, 'altitude', '{:.0f} m',
-                                        x=0.9, y=0.95))
+            self.add_text_line(TextLine(
+                self.fig, 'altitude', '{:.0f} m',
+                x=layout.get('altitude_text', 'x'),
+                y=layout.get('altitude_text', 'y')))
             self.add_text_line(TextLine(self.fig, 'grad', '{:5.1f}%'))
 
         # Near the map
         if 'distance' in self.fields:
-            self.add_text_line(TextLine(self.fig, 'distance', '{:.1f} km',
-                                        y=0.75, scale=0.001))
+            self.add_text_line(TextLine(
+                self.fig, 'distance', '{:.1f} km',
+                x=layout.get('distance_text', 'x'),
+                y=layout.get('distance_text', 'y'), scale=0.001))
 
     # @property
     # def fit_file_names(self):
@@ -220,7 +287,9 @@ class PlotVar:
         return f'{value:.0f} {self.units:}'
 
 
-supported_plots = ['cadence', 'speed', 'power', 'heart_rate', 'None']
+supported_plots = ['cadence', 'speed', 'power', 'heart_rate', 'power_3s',
+                   'power_10s', 'power_30s', 'power_ema', 'normalized_power',
+                   'None']
 
 
 def new_plot_var(variable):
@@ -238,6 +307,16 @@ def new_plot_var(variable):
     if variable == 'heart_rate':
         return PlotVar('heart_rate', 'HeartRate', 'BPM', 200.0)
 
+    if variable in ['power_3s', 'power_10s', 'power_30s']:
+        seconds = variable.split('_')[1]
+        return PlotVar(variable, f'Power {seconds}', 'W', 1000.0)
+
+    if variable == 'power_ema':
+        return PlotVar(variable, 'Power EMA', 'W', 1000.0)
+
+    if variable == 'normalized_power':
+        return PlotVar(variable, 'NP', 'W', 1000.0)
+
     if variable == 'None':
         return None
 
@@ -245,6 +324,51 @@ def new_plot_var(variable):
                      ', '.join([str(v) for v in supported_plots]))
 
 
+map_projections = ['platecarree', 'mercator', 'utm']
+
+
+def new_projection(name, longitude, latitude):
+    '''Return the cartopy projection for the map. UTM uses the zone of the
+    centre of the track
+    '''
+    if name == 'platecarree':
+        return crs.PlateCarree()
+
+    if name == 'mercator':
+        return crs.Mercator()
+
+    if name == 'utm':
+        lon = 0.5 * (np.min(longitude) + np.max(longitude))
+        lat = 0.5 * (np.min(latitude) + np.max(latitude))
+        zone = int((lon + 180.0) // 6.0) % 60 + 1
+        return crs.UTM(zone, southern_hemisphere=lat < 0.0)
+
+    raise ValueError(f'Illegal projection {name}. Must be one of: ' +
+                     ', '.join(map_projections))
+
+
+def rasterize(artist, axes):
+    '''Replace artist with an image of its pixels within the axes.
+    The figure layout must be final.
+    '''
+    fig = axes.figure
+    fig.canvas.draw()  # Apply the layout and aspect ratios
+    renderer = RendererAgg(int(round(fig.bbox.width)),
+                           int(round(fig.bbox.height)), fig.dpi)
+    artist.draw(renderer)
+
+    pixels = fcomp.rgba_pixels(renderer)
+    bbox = axes.get_window_extent(renderer)
+    x0, x1 = int(bbox.x0), int(np.ceil(bbox.x1))
+    y0, y1 = int(bbox.y0), int(np.ceil(bbox.y1))
+    height = pixels.shape[0]
+
+    # Below the axes so it stays under the highlighted points
+    artist.remove()
+    return fig.figimage(pixels[height - y1:height - y0, x0:x1].copy(),
+                        xo=x0, yo=y0, origin='upper', zorder=-1)
+
+
 class PlotBase:
     '''Base class for a plot
     '''
@@ -273,8 +397,11 @@ class PlotBase:
 class BarPlotBase(PlotBase):
     '''Bar Plot Base Class
     '''
-    def __init__(self, plot_vars, axes):
+    def __init__(self, plot_vars, axes, text_offset=None):
         PlotBase.__init__(self)
+        if text_offset:
+            self.txt_dx, self.txt_dy = text_offset
+
         self.bar = None  # To be set in derived classes
         self.plot_vars = plot_vars
         self.axes = axes
@@ -291,25 +418,53 @@ class BarPlotBase(PlotBase):
         for i, _ in enumerate(self.plot_vars):
             self.append_text(i)
 
+        # (bar, text, normalised values, value texts) for each variable
+        # in the current frame window
+        self.window = None
+        self.columns = []
+
     @property
     def fit_file_names(self):
         '''Returns list of fit file record variable names requred for this plot
         '''
         return [plot_var.fit_file_name for plot_var in self.plot_vars]
 
-    def update(self, data):
-        '''Updates the stored variables from data
+    @property
+    def dynamic_artists(self):
+        '''Returns list of artists changed by update
         '''
+        return list(self.bar) + self.text
+
+    def prepare(self, window):
+        '''Calculate the scaled values and text for each frame in the window
+        '''
+        self.window = window
+        self.columns = []
         for i, plot_var in enumerate(self.plot_vars):
-            if not (plot_var.fit_file_name in data):
+            if plot_var.fit_file_name not in window.arrays:
                 continue
 
-            value = plot_var.get_value(data)
-            self.text[i].set_text(plot_var.get_value_units(value))
+            values = plot_var.get_value(window.arrays).tolist()
+            texts = [plot_var.get_value_units(value) for value in values]
 
             # scale the value for the bar chart
-            value = plot_var.get_norm_value(data)
-            self.set_bar_value(self.bar[i], value)
+            norm = plot_var.get_norm_value(window.arrays).tolist()
+            self.columns.append((self.bar[i], self.text[i], norm, texts))
+
+    def update(self, frame):
+        '''Updates the bars to the frame
+        '''
+        if frame.window is not self.window:
+            self.prepare(frame.window)
+
+        index = frame.index
+        for bar, text, norm, texts in self.columns:
+            value = norm[index]
+            if value != value:  # NaN, missing data
+                continue
+
+            text.set_text(texts[index])
+            self.set_bar_value(bar, value)
 
     def set_bar_value(self, bar, value):
         '''Sets the value of the bar.
@@ -333,8 +488,8 @@ class BarPlot(BarPlotBase):
     txt_dx = -0.12
     txt_dy = 0.05
 
-    def __init__(self, plot_vars, axes):
-        BarPlotBase.__init__(self, plot_vars, axes)
+    def __init__(self, plot_vars, axes, text_offset=None):
+        BarPlotBase.__init__(self, plot_vars, axes, text_offset)
         self.axes.set_ylim(0.0, 1.0)
         self.axes.get_yaxis().set_visible(False)
 
@@ -363,8 +518,8 @@ class HBarPlot(BarPlotBase):
     txt_dx = 0.01
     txt_dy = -0.28
 
-    def __init__(self, plot_vars, axes):
-        BarPlotBase.__init__(self, plot_vars, axes)
+    def __init__(self, plot_vars, axes, text_offset=None):
+        BarPlotBase.__init__(self, plot_vars, axes, text_offset)
         self.axes.set_xlim(0.0, 1.0)
         self.axes.get_xaxis().set_visible(False)
 
@@ -387,6 +542,72 @@ class HBarPlot(BarPlotBase):
                                         plot_var.get_value_units(0.0)))
 
 
+class Trail:
+    '''The track up to the current record, drawn as one artist
+    '''
+    def __init__(self, axes, **kwargs):
+        self.line, = axes.plot([], [], marker='.', linestyle='none',
+                               zorder=3, **kwargs)
+        self.points = np.empty((2, 0))
+        self.count = []
+        self.length = 0
+
+    def set_track(self, x_list, y_list, count):
+        '''Set the points of the full track. count is the number of track
+        points up to and including each record
+        '''
+        self.points = np.array([x_list, y_list], dtype=float)
+        self.count = np.asarray(count).tolist()
+        self.set_length(0)
+
+    def show_record(self, index):
+        '''Show the track up to the record at index
+        '''
+        if self.count[index] != self.length:
+            self.set_length(self.count[index])
+
+    def set_length(self, length):
+        '''Show the track up to point length
+        '''
+        self.length = min(length, self.points.shape[1])
+        self.line.set_data(self.points[0, :self.length],
+                           self.points[1, :self.length])
+
+
+class Marker:
+    '''The current, interpolated, position. Moved every frame
+    '''
+    def __init__(self, axes, x_name, y_name, **kwargs):
+        self.line, = axes.plot([], [], marker='.', linestyle='none',
+                               zorder=4, **kwargs)
+        self.x_name = x_name
+        self.y_name = y_name
+
+        # Optional function converting the window x and y arrays to plot
+        # coordinates, applied once per window
+        self.project = None
+
+        # Frame values of the current window
+        self.window = None
+        self.x = None
+        self.y = None
+
+    def update(self, frame):
+        '''Move to the position of the frame
+        '''
+        if frame.window is not self.window:
+            self.window = frame.window
+            self.x = frame.window.arrays.get(self.x_name)
+            self.y = frame.window.arrays.get(self.y_name)
+            if self.project and self.x is not None and self.y is not None:
+                self.x, self.y = self.project(self.x, self.y)
+
+        if self.x is not None and self.y is not None:
+            index = frame.index
+            self.line.set_data(self.x[index:index + 1],
+                               self.y[index:index + 1])
+
+
 class ElevationPlot(PlotBase):
     '''Plot showing the activity elevation trace
     '''
@@ -404,19 +625,25 @@ class ElevationPlot(PlotBase):
         self.axes.set_aspect(self.vertical_scale)
         self.axes.tick_params(axis='both', which='both', length=0)
 
-    def draw_base_plot(self, dist_list, elev_list):
-        '''Draw full elevation profile on the background
+        self.base = None
+        self.trail = Trail(self.axes, color=self.highlight_color,
+                           markersize=self.pms)
+        self.marker = Marker(self.axes, 'distance', 'altitude',
+                             color=self.highlight_color, markersize=self.pms)
+
+    def draw_base_plot(self, dist_list, elev_list, count):
+        '''Draw full elevation profile on the background. count is the
+        number of points up to each record
         '''
-        self.axes.plot(dist_list, elev_list, marker='.', markersize=self.pms,
-                       alpha=self.alpha)
+        self.base, = self.axes.plot(dist_list, elev_list, marker='.',
+                                    markersize=self.pms, alpha=self.alpha)
+        self.trail.set_track(dist_list, elev_list, count)
 
-    def update(self, data):
+    def update(self, frame):
         '''Draw the current elvation profile point
         '''
-        if 'distance' in data and 'altitude' in data:
-            self.axes.plot(data['distance'], data['altitude'],
-                           color=self.highlight_color,
-                           marker='.', markersize=self.pms)
+        self.trail.show_record(frame.record)
+        self.marker.update(frame)
 
     @property
     def fit_file_names(self):
@@ -424,31 +651,59 @@ class ElevationPlot(PlotBase):
         '''
         return ['distance', 'altitude']
 
+    @property
+    def dynamic_artists(self):
+        '''Returns list of artists changed by update
+        '''
+        return [self.trail.line, self.marker.line]
+
 
 class MapPlot(PlotBase):
-    '''Plot show the activity position trace
+    '''Plot show the activity position trace. The positions are projected
+    once, so the axes are plain matplotlib axes in projected coordinates
     '''
-    def __init__(self, axes, projection):
+    def __init__(self, axes, projection='platecarree'):
         PlotBase.__init__(self)
         self.axes = axes
-        self.axes.outline_patch.set_visible(False)
-        self.axes.background_patch.set_visible(False)
+        self.axes.set_axis_off()
+        self.axes.set_aspect('equal')
         self.projection = projection
+        self.crs = None
 
-    def draw_base_plot(self, long_list, lati_list):
-        '''Draw full activity trace on the background
-        '''
-        lon_min = min(long_list)
-        lon_max = max(long_list)
-        lat_min = min(lati_list)
-        lat_max = max(lati_list)
-        dlon = lon_max - lon_min
-        dlat = lat_max - lat_min
-        extent = [lon_min - 0.02 * dlon, lon_max + 0.05 * dlon,
-                  lat_min - 0.02 * dlat, lat_max + 0.02 * dlat]
-        self.axes.set_extent(extent, crs=self.projection)
-        self.axes.scatter(long_list, lati_list, s=self.sms, marker='.',
-                          alpha=self.alpha, transform=self.projection)
+        self.base = None
+        self.trail = Trail(self.axes, color=self.highlight_color,
+                           markersize=np.sqrt(self.sms), alpha=self.alpha)
+        self.marker = Marker(self.axes, 'position_long', 'position_lat',
+                             color=self.highlight_color,
+                             markersize=np.sqrt(self.sms))
+
+    def project(self, long_list, lati_list):
+        '''Return the projected x and y arrays of the positions
+        '''
+        points = self.crs.transform_points(crs.PlateCarree(),
+                                           np.asarray(long_list, dtype=float),
+                                           np.asarray(lati_list, dtype=float))
+        return points[:, 0], points[:, 1]
+
+    def draw_base_plot(self, long_list, lati_list, count):
+        '''Draw full activity trace on the background. count is the number
+        of points up to each record
+        '''
+        self.crs = new_projection(self.projection, long_list, lati_list)
+        self.marker.project = self.project
+        x_list, y_list = self.project(long_list, lati_list)
+
+        x_min = np.min(x_list)
+        x_max = np.max(x_list)
+        y_min = np.min(y_list)
+        y_max = np.max(y_list)
+        dx = x_max - x_min
+        dy = y_max - y_min
+        self.axes.set_xlim(x_min - 0.02 * dx, x_max + 0.05 * dx)
+        self.axes.set_ylim(y_min - 0.02 * dy, y_max + 0.02 * dy)
+        self.base = self.axes.scatter(x_list, y_list, s=self.sms,
+                                      marker='.', alpha=self.alpha)
+        self.trail.set_track(x_list, y_list, count)
 
     def get_height_over_width(self):
         '''Calculate and return the map height to width ratio
@@ -459,17 +714,20 @@ class MapPlot(PlotBase):
         delta_x = xmax - xmin
         return delta_y / delta_x
 
-    def update(self, data):
+    def update(self, frame):
         '''Draw the next data point
         '''
-        if 'position_lat' in data and 'position_long' in data:
-            self.axes.scatter(data['position_long'], data['position_lat'],
-                              color=self.highlight_color, marker='.',
-                              s=self.sms, alpha=self.alpha,
-                              transform=self.projection)
+        self.trail.show_record(frame.record)
+        self.marker.update(frame)
 
     @property
     def fit_file_names(self):
         '''Returns list of fit file record variable names requred for this plot
         '''
         return ['position_lat', 'position_long']
+
+    @property
+    def dynamic_artists(self):
+        '''Returns list of artists changed by update
+        '''
+        return [self.trail.line, self.marker.line]
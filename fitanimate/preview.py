@@ -0,0 +1,118 @@
+'''Quick previews of the animation layout from a few key frames
+'''
+import os
+import copy
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import fitanimate.animator as ani
+import fitanimate.data as fad
+import fitanimate.compositor as fcomp
+
+
+def keyframes(data_set, count):
+    '''Return a sorted list of (record index, label) of up to count
+    interesting records, padded with evenly spaced records. If there are
+    more, the start and finish are kept first, then the end of the first
+    lap and the maxima in the order listed
+    '''
+    last = len(data_set) - 2  # The last record with frames
+    if last < 0:
+        return []
+
+    # In order of priority
+    keys = {0: 'Start'}
+    keys.setdefault(last, 'Finish')
+    laps = data_set.events.get('lap')
+    if laps:
+        index = int(np.searchsorted(data_set.timestamps, laps.timestamps[0]))
+        if index <= last:
+            keys.setdefault(index, 'End of lap 1')
+
+    for name, label in [('power', 'Max power'), ('speed', 'Max speed'),
+                        ('altitude', 'Highest point'), ('grad', 'Steepest'),
+                        ('heart_rate', 'Max heart rate')]:
+        values = data_set.columns.get(name)
+        if values is not None and not np.isnan(values[:last + 1]).all():
+            keys.setdefault(int(np.nanargmax(values[:last + 1])), label)
+
+    for index in np.linspace(0, last, count).astype(int).tolist():
+        if len(keys) >= count:
+            break
+
+        elapsed = int(data_set.timestamps[index] - data_set.timestamps[0])
+        keys.setdefault(index, f'{elapsed // 3600}:{elapsed // 60 % 60:02d}:'
+                               f'{elapsed % 60:02d}')
+
+    return sorted(list(keys.items())[:count])
+
+
+def render_keyframes(args, data_set, keys):
+    '''Return images of the (record index, label) keys. Run in a worker
+    process with its own figure
+    '''
+    animator = ani.Animator(args)
+    animator.setup_figure()
+    animator.data_generator = fad.DataGen(data_set)
+    animator.draw()
+
+    label = animator.fig.text(0.5, 0.98, '', ha='center', va='top')
+    images = []
+    for index, name in keys:
+        animator.show_record(index)
+        label.set_text(name)
+        animator.fig.canvas.draw()
+        images.append(
+            fcomp.rgba_pixels(animator.fig.canvas.get_renderer()).copy())
+
+    animator.close()
+    return images
+
+
+def contact_sheet(images, columns):
+    '''Return the images tiled into rows of columns images
+    '''
+    height, width, depth = images[0].shape
+    rows = -(-len(images) // columns)
+    sheet = np.zeros((rows * height, columns * width, depth), dtype=np.uint8)
+    for i, image in enumerate(images):
+        row, column = divmod(i, columns)
+        sheet[row * height:(row + 1) * height,
+              column * width:(column + 1) * width] = image
+
+    return sheet
+
+
+def preview(animator, count=12, jobs=1):
+    '''Render count key frames over jobs processes and save them as a
+    contact sheet image
+    '''
+    data_set = animator.data_generator.data_set
+    keys = keyframes(data_set, count)
+    if len(keys) < 1:
+        print('No data to preview.')
+        return
+
+    # Open files can not be passed to the workers, they are not needed
+    args = copy.copy(animator.args)
+    args.infile = None
+    args.merge = []
+
+    jobs = max(1, min(jobs, len(keys)))
+    chunks = [keys[i::jobs] for i in range(jobs)]
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(render_keyframes, [args] * jobs,
+                                [data_set] * jobs, chunks))
+
+    # Undo the interleaving of the chunks
+    images = [results[i % jobs][i // jobs] for i in range(len(keys))]
+
+    # The preview is always a PNG, whatever the extension of --outfile
+    outf = animator.output_name('_preview.png')
+    if animator.args.outfile:
+        outf = os.path.splitext(animator.args.outfile)[0] + '_preview.png'
+
+    plt.imsave(outf, contact_sheet(images, int(np.ceil(np.sqrt(len(keys))))))
+    print(f'Saved preview of {len(keys)} frames to {outf}')
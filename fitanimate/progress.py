@@ -0,0 +1,140 @@
+'''Report the progress of a render: frames done, frame rate and ETA
+'''
+import os
+import sys
+import json
+import time
+from collections import deque
+
+
+class Progress:
+    '''Track the frames done of a stage and pass a report to each callback.
+
+    A report is a dict with the stage, frame (done), total, fps (over the
+    last few seconds), eta and elapsed seconds, plus any fixed info such as
+    the video format and the latest per frame values such as
+    redrawn_percent. Reports are made at most every interval seconds,
+    and always when the stage changes or finishes.
+    '''
+    def __init__(self, total, callbacks=(), info=None, interval=0.5):
+        self.total = total
+        self.callbacks = list(callbacks)
+        self.info = info or {}
+        self.interval = interval
+
+        self.stage = None
+        self.done = 0
+        self.values = {}
+        self.start = time.monotonic()
+        self.last_report = None
+
+        # (time, frames done) over the recent past for the current fps
+        self.history = deque()
+
+    def report(self):
+        '''Return the current progress report
+        '''
+        now = time.monotonic()
+        fps = 0.0
+        if len(self.history) > 1:
+            (start, first), (end, last) = self.history[0], self.history[-1]
+            if end > start:
+                fps = (last - first) / (end - start)
+
+        eta = None
+        if fps > 0.0:
+            eta = max(self.total - self.done, 0) / fps
+
+        return dict(self.info, **self.values, stage=self.stage,
+                    frame=self.done, total=self.total, fps=round(fps, 2),
+                    eta=None if eta is None else round(eta, 1),
+                    elapsed=round(now - self.start, 1))
+
+    def notify(self, force=False):
+        '''Pass the report to the callbacks, unless one was made recently
+        '''
+        now = time.monotonic()
+        if (not force and self.last_report is not None and
+                now - self.last_report < self.interval):
+            return
+
+        self.last_report = now
+        report = self.report()
+        for callback in self.callbacks:
+            callback(report)
+
+    def set_stage(self, stage):
+        '''Start a new stage, eg. load, render or encode
+        '''
+        self.stage = stage
+        self.notify(force=True)
+
+    def update(self, done, **values):
+        '''Set the number of frames done and the values of the last frame
+        '''
+        self.done = done
+        self.values.update(values)
+        now = time.monotonic()
+        self.history.append((now, done))
+        while len(self.history) > 2 and now - self.history[0][0] > 5.0:
+            self.history.popleft()
+
+        self.notify(force=done >= self.total)
+
+    def frames(self, iterable):
+        '''Yield from iterable, counting a frame as done when the next one
+        is requested
+        '''
+        for done, item in enumerate(iterable):
+            self.update(done)
+            yield item
+
+    def finish(self):
+        '''Mark the render as done
+        '''
+        self.done = self.total
+        self.set_stage('done')
+
+
+def duration(seconds):
+    '''Return seconds as [H:]MM:SS
+    '''
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+    return f'{minutes:02d}:{seconds:02d}'
+
+
+class TerminalBar:
+    '''Progress bar on one terminal line
+    '''
+    def __init__(self, stream=None, width=30):
+        self.stream = stream or sys.stderr
+        self.width = width
+
+    def __call__(self, report):
+        total = max(report['total'], 1)
+        filled = int(self.width * min(report['frame'] / total, 1.0))
+        eta = '--:--' if report['eta'] is None else duration(report['eta'])
+        line = (f"\r{report['stage']:>7} [{'#' * filled}"
+                f"{'.' * (self.width - filled)}] {report['frame']}/"
+                f"{report['total']} {report['fps']:.1f} fps ETA {eta} ")
+        if report['stage'] == 'done':
+            line = (f"\r   done [{'#' * self.width}] {report['total']} frames "
+                    f"in {duration(report['elapsed'])}\n")
+
+        self.stream.write(line)
+        self.stream.flush()
+
+
+class JsonLines:
+    '''Write each report as a line of JSON to a file descriptor
+    '''
+    def __init__(self, fd):
+        self.out = os.fdopen(fd, 'w', buffering=1, closefd=False)
+
+    def __call__(self, report):
+        self.out.write(json.dumps(dict(report, time=round(time.time(), 3)))
+                       + '\n')
@@ -0,0 +1,201 @@
+'''Write small synthetic FIT files for the tests and the benchmark
+
+Only the messages and fields read by fitanimate are written. Run as a
+script to remake the fixtures in tests/data:
+
+    python tests/fitfile.py
+'''
+import os
+import math
+import struct
+import random
+
+# Seconds from the Unix epoch to the FIT epoch, 1989-12-31 00:00 UTC
+FIT_EPOCH = 631065600
+
+CRC_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+# name: (global message number, [(field, number, struct format, base type)])
+messages = {
+    'file_id': (0, [('type', 0, 'B', 0x00), ('manufacturer', 1, 'H', 0x84),
+                    ('time_created', 4, 'I', 0x86)]),
+    'record': (20, [('timestamp', 253, 'I', 0x86),
+                    ('position_lat', 0, 'i', 0x85),
+                    ('position_long', 1, 'i', 0x85),
+                    ('altitude', 2, 'H', 0x84), ('heart_rate', 3, 'B', 0x02),
+                    ('cadence', 4, 'B', 0x02), ('distance', 5, 'I', 0x86),
+                    ('speed', 6, 'H', 0x84), ('power', 7, 'H', 0x84),
+                    ('temperature', 13, 'b', 0x01)]),
+    'lap': (19, [('timestamp', 253, 'I', 0x86), ('event', 0, 'B', 0x00),
+                 ('event_type', 1, 'B', 0x00), ('start_time', 2, 'I', 0x86)]),
+    'event': (21, [('timestamp', 253, 'I', 0x86), ('event', 0, 'B', 0x00),
+                   ('event_type', 1, 'B', 0x00), ('data', 3, 'I', 0x86)]),
+}
+
+# Invalid (missing) value of each struct format
+invalid = {'B': 0xFF, 'b': 0x7F, 'H': 0xFFFF, 'I': 0xFFFFFFFF,
+           'i': 0x7FFFFFFF}
+
+
+def crc(data, value=0):
+    '''Return the FIT CRC of data
+    '''
+    for byte in data:
+        for nibble in (byte & 0xF, byte >> 4):
+            tmp = CRC_TABLE[value & 0xF]
+            value = (value >> 4) & 0x0FFF
+            value = value ^ tmp ^ CRC_TABLE[nibble]
+
+    return value
+
+
+class FitWriter:
+    '''Build a FIT file from messages of unscaled field values. Missing
+    fields are written as invalid values
+    '''
+    def __init__(self):
+        self.data = bytearray()
+        self.local = {}
+
+    def add(self, name, **values):
+        '''Add a message, defining it first if needed
+        '''
+        number, fields = messages[name]
+        if name not in self.local:
+            self.local[name] = len(self.local)
+            self.data += struct.pack('<BBBHB', 0x40 | self.local[name], 0, 0,
+                                     number, len(fields))
+            for _, field, fmt, base_type in fields:
+                self.data += struct.pack('<BBB', field, struct.calcsize(fmt),
+                                         base_type)
+
+        self.data += struct.pack('<B', self.local[name])
+        for field, _, fmt, _ in fields:
+            value = values.get(field)
+            self.data += struct.pack(
+                '<' + fmt, invalid[fmt] if value is None else value)
+
+    def record(self, timestamp, lat=None, lon=None, altitude=None,
+               distance=None, speed=None, **values):
+        '''Add a record in natural units: Unix time, degrees, metres and
+        metres per second
+        '''
+        def scaled(value, scale, offset=0.0):
+            return None if value is None else int(round((value + offset) *
+                                                        scale))
+
+        self.add('record', timestamp=timestamp - FIT_EPOCH,
+                 position_lat=scaled(lat, 2.0**31 / 180.0),
+                 position_long=scaled(lon, 2.0**31 / 180.0),
+                 altitude=scaled(altitude, 5.0, 500.0),
+                 distance=scaled(distance, 100.0),
+                 speed=scaled(speed, 1000.0), **values)
+
+    def lap(self, timestamp, start):
+        '''Add the end of a lap that started at start
+        '''
+        self.add('lap', timestamp=timestamp - FIT_EPOCH, event=9,
+                 event_type=1, start_time=start - FIT_EPOCH)
+
+    def gear_change(self, timestamp, front, rear):
+        '''Add a rear gear change event
+        '''
+        self.add('event', timestamp=timestamp - FIT_EPOCH, event=43,
+                 event_type=3, data=rear << 8 | front << 24)
+
+    def bytes(self):
+        '''Return the file contents
+        '''
+        header = struct.pack('<BBHI4s', 14, 0x10, 2093, len(self.data),
+                             b'.FIT')
+        header += struct.pack('<H', crc(header))
+        contents = header + bytes(self.data)
+        return contents + struct.pack('<H', crc(contents))
+
+    def save(self, path):
+        '''Write the file to path
+        '''
+        with open(path, 'wb') as out:
+            out.write(self.bytes())
+
+
+def ride(seconds=600, start=1577872800, seed=1, power=True,
+         smart_recording=False, pause=None):
+    '''Return a FitWriter of a ride round a hilly loop with laps every 5
+    minutes and a few gear changes. Smart recording skips 1 to 7 seconds
+    between records. pause is (start, seconds) of a gap with no records
+    '''
+    random.seed(seed)
+    writer = FitWriter()
+    writer.add('file_id', type=4, manufacturer=255,
+               time_created=start - FIT_EPOCH)
+
+    distance = 0.0
+    elapsed = 0
+    lap_start = start
+    gear = 0
+    while elapsed < seconds:
+        speed = 8.0 + 2.0 * math.sin(elapsed / 40.0) + random.gauss(0, 0.2)
+        distance += speed
+        angle = 2.0 * math.pi * distance / 5000.0
+        writer.record(
+            start + elapsed, 46.0 + 0.008 * math.sin(angle),
+            7.0 + 0.012 * math.cos(angle),
+            100.0 + 20.0 * math.sin(3.0 * angle), distance, speed,
+            heart_rate=None if 50 <= elapsed < 60 else
+            int(120 + 30 * (1.0 - math.exp(-elapsed / 200.0))),
+            cadence=int(88 + random.gauss(0, 3)) if power else None,
+            power=max(0, int(250 + 60 * math.sin(elapsed / 23.0) +
+                             random.gauss(0, 25))) if power else None,
+            temperature=int(20 + elapsed / 600))
+
+        if elapsed - (lap_start - start) >= 300:
+            writer.lap(start + elapsed, lap_start)
+            lap_start = start + elapsed
+
+        if elapsed >= 25 + 130 * gear:
+            writer.gear_change(start + elapsed, 50 - 16 * (gear % 2),
+                               15 + gear % 5)
+            gear += 1
+
+        step = random.randint(1, 7) if smart_recording else 1
+        if pause and elapsed < pause[0] <= elapsed + step:
+            step += pause[1]
+
+        elapsed += step
+
+    return writer
+
+
+def power_meter(seconds=600, start=1577872800, seed=2, offset=2):
+    '''Return a FitWriter of power meter records, offset seconds later
+    than a ride with the same start
+    '''
+    random.seed(seed)
+    writer = FitWriter()
+    writer.add('file_id', type=4, manufacturer=255,
+               time_created=start - FIT_EPOCH)
+    for elapsed in range(offset, seconds):
+        writer.record(start + elapsed,
+                      power=int(240 + 80 * math.sin(elapsed / 17.0) +
+                                random.gauss(0, 20)),
+                      cadence=int(90 + random.gauss(0, 2)))
+
+    return writer
+
+
+def main():
+    '''Write the fixtures: a ride with smart recording and a two minute
+    pause, and power meter data to merge with it
+    '''
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'data')
+    os.makedirs(directory, exist_ok=True)
+    ride(900, power=False, smart_recording=True, pause=(400, 120)).save(
+        os.path.join(directory, 'ride.fit'))
+    power_meter(900).save(os.path.join(directory, 'power.fit'))
+
+
+if __name__ == '__main__':
+    main()
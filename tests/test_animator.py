@@ -0,0 +1,47 @@
+'''Several jobs in one process
+'''
+import matplotlib
+matplotlib.use('Agg')
+
+import fitanimate.fitanimate as fa
+import fitanimate.animator as ani
+import fitfile
+
+
+def make_animator(path, *options):
+    args = fa.make_parser().parse_args(
+        [str(path), '--format', '240p'] + list(options),
+        config_file_contents='', env_vars={})
+    animator = ani.Animator(args)
+    animator.setup()
+    args.infile.close()
+    animator.close()
+    return animator
+
+
+def test_jobs_do_not_change_the_defaults(tmp_path):
+    path = tmp_path / 'ride.fit'
+    fitfile.ride(60).save(path)
+    fields = list(ani.default_fields)
+    plots = list(ani.default_plots)
+
+    hidden = make_animator(path, '--no-map', '--no-elevation')
+    assert not {'distance', 'altitude', 'grad'} & set(hidden.args.fields)
+    assert ani.default_fields == fields
+    assert ani.default_plots == plots
+
+    plain = make_animator(path)
+    assert plain.args.fields == fields
+    assert plain.args.plots == plots
+
+
+def test_same_options_use_the_cached_figure(tmp_path):
+    path = tmp_path / 'ride.fit'
+    fitfile.ride(60).save(path)
+    ani.figure_templates.clear()
+
+    first = make_animator(path, '--no-map')
+    second = make_animator(path, '--no-map')
+    assert (ani.figure_template_key(first.args) ==
+            ani.figure_template_key(second.args))
+    assert len(ani.figure_templates) == 1
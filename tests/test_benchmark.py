@@ -0,0 +1,48 @@
+'''Golden frame checks of the render paths on the FIT fixtures
+'''
+import os
+import sys
+import glob
+import subprocess
+
+import matplotlib
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def benchmark(*options):
+    '''Run the benchmark without the encoder timings
+    '''
+    return subprocess.run(
+        [sys.executable, '-m', 'fitanimate.benchmark', '--profiles'] +
+        list(options), cwd=ROOT, stdout=subprocess.PIPE,
+        universal_newlines=True)
+
+
+def golden_version():
+    '''Return the matplotlib version of the golden images
+    '''
+    names = glob.glob(os.path.join(ROOT, 'tests', 'data', 'golden', '*.png'))
+    with Image.open(names[0]) as image:
+        return image.text.get('matplotlib')
+
+
+def test_render_paths_match_reference():
+    result = benchmark('--frames', '0', '9', '10', '37', '--golden', '')
+    assert result.returncode == 0, result.stdout
+
+
+@pytest.mark.skipif(golden_version() != matplotlib.__version__,
+                    reason='The golden images are for another matplotlib')
+def test_reference_matches_golden_images():
+    result = benchmark('--frames', '0', '99', '150', '--modes', 'dirty-rect')
+    assert result.returncode == 0, result.stdout
+    assert 'golden' in result.stdout
+
+
+def test_no_rendered_frames():
+    # Keyframes only renders the frames of records
+    result = benchmark('--frames', '5', '--modes', 'keyframes', '--golden', '')
+    assert result.returncode == 0, result.stdout
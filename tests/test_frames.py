@@ -0,0 +1,45 @@
+'''Allocations of the per frame plot updates
+'''
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+
+import fitanimate.fitanimate as fa
+import fitanimate.animator as ani
+import fitanimate.data as fad
+import fitfile
+
+
+def test_frame_updates_do_not_allocate(tmp_path):
+    path = tmp_path / 'ride.fit'
+    fitfile.ride(700).save(path)
+    args = fa.make_parser().parse_args([str(path), '--format', '240p'],
+                                       config_file_contents='', env_vars={})
+    animator = ani.Animator(args)
+    animator.setup()
+    animator.draw()
+    args.infile.close()
+
+    # The first frames prepare the window, the rest are in the same window
+    frames = animator.data_generator()
+    plots = tuple(animator.plots)
+    for _ in range(20):
+        fad.run(next(frames), animator.fig, plots)
+
+    count = 2000
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(count):
+        fad.run(next(frames), animator.fig, plots)
+
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    animator.close()
+
+    # Nothing is kept per frame, and what is made is small and freed
+    blocks = sum(stat.count_diff
+                 for stat in after.compare_to(before, 'lineno'))
+    assert blocks / count < 0.05
+    assert peak < 64 * 1024
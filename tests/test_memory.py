@@ -0,0 +1,51 @@
+'''Peak memory use of the memory bounded mode
+'''
+import os
+import sys
+import subprocess
+
+import pytest
+
+import fitanimate.data as fad
+import fitfile
+
+# Read the data as in --max-memory mode and make all the frame windows,
+# then print the peak memory use
+SCRIPT = '''
+import sys
+import fitanimate.data as fad
+
+with open(sys.argv[1], 'rb') as infile:
+    data_set = fad.pre_pocess_data(
+        infile, ['temperature', 'heart_rate', 'altitude', 'distance',
+                 'position_lat', 'position_long', 'cadence', 'speed',
+                 'power'], low_memory=True)
+
+for window in fad.DataGen(data_set, 60).windows():
+    pass
+
+print(fad.peak_memory())
+'''
+
+
+def peak_memory(path):
+    '''Return the peak memory use in MB of SCRIPT reading path
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', SCRIPT, str(path)], check=True,
+        stdout=subprocess.PIPE, universal_newlines=True,
+        env=dict(os.environ, PYTHONPATH=root))
+    return float(result.stdout)
+
+
+@pytest.mark.skipif(fad.peak_memory() is None,
+                    reason='Peak memory use is not available')
+def test_peak_memory_is_flat(tmp_path):
+    records = 1800
+    short, long = tmp_path / 'short.fit', tmp_path / 'long.fit'
+    fitfile.ride(records).save(short)
+    fitfile.ride(10 * records).save(long)
+
+    # The interpreter and libraries dominate, the data adds a little
+    assert peak_memory(long) < 1.25 * peak_memory(short)
@@ -0,0 +1,56 @@
+'''Smoothing over time windows of irregular records
+'''
+import numpy as np
+
+import fitanimate.data as fad
+
+
+def test_rolling_mean_uses_seconds():
+    # Smart recording: a record every 1 to 8 seconds
+    timestamps = np.array([0, 1, 2, 10, 11, 19, 27, 28, 29, 30])
+    values = np.arange(len(timestamps), dtype=float)
+    smoothed = fad.rolling_mean(values, timestamps, 10)
+
+    # The records in the 10 seconds up to 30 are at 27, 28, 29 and 30
+    assert smoothed[-1] == np.mean(values[-4:])
+    # Not the 10 records before, which go back to 0
+    assert smoothed[5] == np.mean(values[3:6])
+
+
+def test_smoothing_restarts_after_pause():
+    timestamps = np.concatenate((np.arange(60), 600 + np.arange(60)))
+    values = np.concatenate((np.full(60, 100.0), np.full(60, 300.0)))
+    for method in ['mean', 'ema', 'np']:
+        smoothed = fad.smoothing_methods[method](values, timestamps, 30)
+        assert np.isclose(smoothed[59], 100.0)
+        if method != 'np':  # Normalized power is for the whole ride
+            assert np.isclose(smoothed[60], 300.0)
+
+
+def test_exponential_mean_matches_recurrence():
+    random = np.random.RandomState(0)
+    timestamps = np.cumsum(random.choice([1, 1, 2, 5, 8, 400], 3000))
+    values = random.normal(200.0, 50.0, len(timestamps))
+    decay = 1.0 - 2.0 / 31.0
+    expected = values.copy()
+    for k in range(1, len(values)):
+        step = timestamps[k] - timestamps[k - 1]
+        if step <= fad.pause_gap:
+            expected[k] = (decay**step * expected[k - 1] +
+                           (1.0 - decay**step) * values[k])
+
+    assert np.allclose(fad.exponential_mean(values, timestamps, 30), expected)
+
+
+def test_missing_values_are_a_gap_in_time():
+    data_set = fad.DataSet()
+    data_set.timestamps = np.arange(100)
+    power = np.full(100, 200.0)
+    power[40:70] = np.nan
+    power[70:] = 400.0
+    data_set.set_column('power', power)
+    data_set.smooth('power_30s', 'power', 'mean', 30)
+
+    smoothed = data_set.columns['power_30s']
+    assert np.isnan(smoothed[40:70]).all()
+    assert smoothed[70] == 400.0